@@ -9,25 +9,38 @@
 BUILD_TIMESTAMP = "2025-11-08 18:20:00 CET"
 BUILD_VERSION = "1.0.3"
 
-from flask import Flask, jsonify, send_file, render_template, request, redirect, url_for, Blueprint
+import time
+IMPORT_STARTED = time.perf_counter()
+
+# Heavy, format-specific modules (rawpy, pillow_heif, ntplib) are imported on
+# first use, see LAZY CODEC LOADING in render.py.
+from flask import Flask, Response, jsonify, send_file, render_template, request, redirect, url_for, Blueprint, g, has_request_context
 import yaml
+import json
 import requests
 import os
 import io
 import random
-import rawpy
-import numpy as np
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageOps
-from pillow_heif import register_heif_opener
+import hashlib
+from PIL import Image, ExifTags
 from datetime import datetime, timedelta
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 import threading
-import ntplib
-import time
+import multiprocessing
+import fcntl
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import sqlite3
 import logging
 import sys
+from contextlib import contextmanager
 from werkzeug.middleware.proxy_fix import ProxyFix
+from framecodec import FRAME_BAND_ROWS, frame_size, pack_frame, hex_frame_length, iter_hex_frame, packbits_encode
+
+STARTUP_REPORT = {
+    'pid': os.getpid(),
+    'imports_ms': round((time.perf_counter() - IMPORT_STARTED) * 1000, 1),
+}
 
 # =============== LOGGING CONFIGURATION ===============
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
@@ -38,39 +51,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# =============== CYTHON MODULE IMPORT ===============
-try:
-    import cpy
-    logger.info(f"Cython functions: {[f for f in dir(cpy) if not f.startswith('_')]}")
-    
-    load_scaled = cpy.load_scaled
-    
-    if hasattr(cpy, 'convert_image'):
-        def convert_image_floyd(img, strength):
-            return cpy.convert_image(img, '', strength)
-        FLOYD_AVAILABLE = True
-    else:
-        FLOYD_AVAILABLE = False
-    
-    if hasattr(cpy, 'convert_image_atkinson'):
-        def convert_image_atkinson(img, strength):
-            return cpy.convert_image_atkinson(img, '', strength)
-        ATKINSON_AVAILABLE = True
-    else:
-        ATKINSON_AVAILABLE = False
-    
-    CYTHON_AVAILABLE = ATKINSON_AVAILABLE or FLOYD_AVAILABLE
-    
-    if CYTHON_AVAILABLE:
-        logger.info(f"Cython available: Floyd={FLOYD_AVAILABLE}, Atkinson={ATKINSON_AVAILABLE}")
-    else:
-        logger.error("No dithering functions found in Cython module")
-        
-except ImportError as e:
-    CYTHON_AVAILABLE = False
-    FLOYD_AVAILABLE = False
-    ATKINSON_AVAILABLE = False
-    logger.error(f"Cython not available: {e}")
+# =============== RENDER MODULE ===============
+# Decoding, dithering and the date overlay live in render.py (imported by the
+# render process pools without the Flask app); it loads the Cython module.
+import render
+from render import (CYTHON_AVAILABLE, DATE_POSITIONS, RAW_EXTENSIONS, timed_stage, record_lazy_import,
+                    ensure_heif_opener, decode_image, scale_img_in_memory, original_thumbnail,
+                    save_source_copy, render_to_cache)
+
+STARTUP_REPORT['cython_ms'] = render.CYTHON_IMPORT_MS
+STARTUP_REPORT['lazy_imports_ms'] = render.LAZY_IMPORTS_MS
 
 # =============== DEFAULT CONFIGURATION ===============
 DEFAULT_CONFIG = {
@@ -84,11 +74,22 @@ DEFAULT_CONFIG = {
         'display_mode': os.getenv('DISPLAY_MODE', 'fill'),
         'image_order': os.getenv('IMAGE_ORDER', 'random'),
         'dithering_method': os.getenv('DITHERING_METHOD', 'atkinson'),
+        'dithering_space': os.getenv('DITHERING_SPACE', 'srgb'),
         'sleep_start_hour': int(os.getenv('SLEEP_START_HOUR', '23')),
         'sleep_start_minute': int(os.getenv('SLEEP_START_MINUTE', '0')),
         'sleep_end_hour': int(os.getenv('SLEEP_END_HOUR', '6')),
         'sleep_end_minute': int(os.getenv('SLEEP_END_MINUTE', '0')),
         'wakeup_interval': int(os.getenv('WAKEUP_INTERVAL', '1440')),
+        'wakeup_window': int(os.getenv('WAKEUP_WINDOW', '10')),
+        'source_cache_size': int(os.getenv('SOURCE_CACHE_SIZE', '500')),
+        'photo_source': os.getenv('PHOTO_SOURCE', 'immich'),
+        'local_folder': os.getenv('LOCAL_FOLDER', '/media/eink'),
+        'debug_profiling': os.getenv('DEBUG_PROFILING', 'false').lower() == 'true',
+        'raw_strategy': os.getenv('RAW_STRATEGY', 'auto'),
+        'shuffle_seed': os.getenv('SHUFFLE_SEED', ''),
+        'date_position': os.getenv('DATE_POSITION', 'bottom-right'),
+        'date_size': int(os.getenv('DATE_SIZE', '20')),
+        'date_format': os.getenv('DATE_FORMAT', '%Y-%m-%d'),
     }
 }
 
@@ -104,34 +105,44 @@ strength = current_config['immich']['strength']
 display_mode = current_config['immich']['display_mode']
 image_order = current_config['immich']['image_order']
 dithering_method = current_config['immich'].get('dithering_method', 'atkinson')
+dithering_space = current_config['immich']['dithering_space']
 sleep_start_hour = current_config['immich']['sleep_start_hour']
 sleep_start_minute = current_config['immich']['sleep_start_minute']
 sleep_end_hour = current_config['immich']['sleep_end_hour']
 sleep_end_minute = current_config['immich']['sleep_end_minute']
+debug_profiling = current_config['immich']['debug_profiling']
+raw_strategy = current_config['immich']['raw_strategy']
+shuffle_seed = current_config['immich']['shuffle_seed']
+date_position = current_config['immich']['date_position']
+date_size = current_config['immich']['date_size']
+date_format = current_config['immich']['date_format']
+photo_source = current_config['immich']['photo_source']
+local_folder = current_config['immich']['local_folder']
 
 # =============== API CONFIGURATION ===============
 api_key = os.getenv('IMMICH_API_KEY')
 photo_dir = os.getenv('IMMICH_PHOTO_DEST', 'photos')
 config_path = os.getenv('CONFIG_PATH', 'config/config.yaml')
-tracking_file = os.path.join(photo_dir, 'tracking.txt')
-
-os.makedirs(photo_dir, exist_ok=True)
-
-if not os.path.exists(tracking_file):
-    open(tracking_file, 'w').close()
 
 headers = {
     'Accept': 'application/json',
     'x-api-key': api_key
 }
 
-ALLOWED_EXTENSIONS = ['.jpeg', '.raw', '.jpg', '.bmp', '.dng', '.heic', '.arw', '.cr2', '.dng', '.nef', '.raw']
-os.makedirs(photo_dir, exist_ok=True)
-register_heif_opener()
+ALLOWED_EXTENSIONS = ['.jpeg', '.raw', '.jpg', '.bmp', '.dng', '.heic', '.arw', '.cr2', '.dng', '.nef', '.raw', '.heif', '.png']
 
 # =============== BATTERY TRACKING ===============
-last_battery_voltage = 0
-last_battery_update = 0
+# Kept in a state file so every gunicorn worker (and the event stream) sees
+# the voltage the ESP32 reported to whichever worker served /download.
+battery_state_file = os.path.join(photo_dir, 'battery.json')
+
+def record_battery(voltage):
+    write_json_file(battery_state_file, {'voltage': voltage, 'updated_at': time.time()})
+
+def read_battery():
+    """Last reported battery voltage (mV) and when it was reported, (0, 0) if never"""
+    state = read_json_file(battery_state_file, {})
+    return state.get('voltage', 0), state.get('updated_at', 0)
 
 BATTERY_LEVELS = {
     4200: 100, 4150: 95, 4110: 90, 4080: 85, 4020: 80,
@@ -140,16 +151,6 @@ BATTERY_LEVELS = {
     3750: 25, 3730: 20, 3710: 15, 3690: 10, 3610: 5, 3400: 0
 }
 
-# =============== 6-COLOR PALETTE ===============
-palette = [
-    (0, 0, 0),         # Black
-    (255, 255, 255),   # White
-    (255, 243, 56),    # Yellow
-    (191, 0, 0),       # Red
-    (100, 64, 255),    # Blue
-    (67, 138, 28)      # Green
-]
-
 def calculate_battery_percentage(voltage):
     """Calculate battery percentage from voltage (Lithium Battery)"""
     if voltage >= 4200:
@@ -166,277 +167,1992 @@ def calculate_battery_percentage(voltage):
             return round(percentage, 1)
     return 0
 
-# =============== IMAGE TRACKING FUNCTIONS ===============
-def load_downloaded_images():
-    """Load downloaded image IDs from tracking.txt"""
-    global album_name
-    try:
-        if not os.path.exists(tracking_file):
-            with open(tracking_file, 'w') as f:
-                pass  # Leere Datei erstellen
+# =============== LOCAL DATABASE & METRICS ===============
+# One SQLite file shared by all gunicorn workers (WAL mode). Connections are
+# per thread and re-opened after a fork.
+db_path = os.path.join(photo_dir, 'epf.db')
+db_local = threading.local()
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    total REAL NOT NULL DEFAULT 0,
+    last REAL,
+    min REAL,
+    max REAL,
+    updated_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS deck (
+    album_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    sort_key TEXT NOT NULL,
+    shown INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (album_id, mode, asset_id)
+);
+CREATE INDEX IF NOT EXISTS deck_next ON deck (album_id, mode, shown, sort_key, asset_id);
+
+CREATE TABLE IF NOT EXISTS deck_meta (
+    album_id TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    seed TEXT NOT NULL,
+    epoch INTEGER NOT NULL DEFAULT 0,
+    last_asset_id TEXT,
+    album_revision INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (album_id, mode)
+);
+
+CREATE TABLE IF NOT EXISTS album_assets (
+    album_id TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    original_path TEXT,
+    taken_at TEXT,
+    updated_at TEXT,
+    revision INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (album_id, asset_id)
+);
+
+CREATE TABLE IF NOT EXISTS prerender_items (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    asset_id TEXT NOT NULL,
+    original_path TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    finished_at REAL,
+    PRIMARY KEY (job_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    next_wakeup REAL,
+    wakeup_offset INTEGER,
+    battery REAL
+);
+
+CREATE TABLE IF NOT EXISTS album_sync (
+    album_name TEXT PRIMARY KEY,
+    album_id TEXT NOT NULL,
+    album_version TEXT,
+    revision INTEGER NOT NULL DEFAULT 0,
+    synced_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS source_cache (
+    asset_id TEXT PRIMARY KEY,
+    original_path TEXT,
+    bytes INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS source_cache_lru ON source_cache (last_used);
+
+CREATE TABLE IF NOT EXISTS folder_files (
+    folder TEXT NOT NULL,
+    path TEXT NOT NULL,
+    asset_id TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    taken_at TEXT,
+    width INTEGER,
+    height INTEGER,
+    PRIMARY KEY (folder, path)
+);
+"""
+
+def get_db():
+    """SQLite connection for the current thread (autocommit)"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None or db_local.pid != os.getpid():
+        conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(DB_SCHEMA)
+        db_local.conn = conn
+        db_local.pid = os.getpid()
+    return conn
+
+def record_metric(name, value=1.0):
+    """
+    Add one observation to a metric (count, total, last, min, max).
+    Plain counters use the default value of 1. Never raises.
+    """
+    try:
+        get_db().execute(
+            """INSERT INTO metrics (name, count, total, last, min, max, updated_at)
+               VALUES (?, 1, ?, ?, ?, ?, ?)
+               ON CONFLICT(name) DO UPDATE SET
+                   count = count + 1,
+                   total = total + excluded.total,
+                   last = excluded.last,
+                   min = MIN(min, excluded.min),
+                   max = MAX(max, excluded.max),
+                   updated_at = excluded.updated_at""",
+            (name, value, value, value, value, time.time())
+        )
+    except sqlite3.Error as e:
+        logger.warning(f"Could not record metric {name}: {e}")
+
+def get_metrics():
+    """All metrics as {name: {count, total, avg, last, min, max}}"""
+    rows = get_db().execute('SELECT name, count, total, last, min, max FROM metrics ORDER BY name')
+    return {
+        name: {
+            'count': count,
+            'total': round(total, 3),
+            'avg': round(total / count, 3) if count else None,
+            'last': last,
+            'min': minimum,
+            'max': maximum,
+        }
+        for name, count, total, last, minimum, maximum in rows
+    }
+
+@contextmanager
+def db_transaction():
+    """Write transaction on the thread's connection; workers queue up behind each other"""
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+# =============== PLAY-ORDER DECKS ===============
+# Every album has a persistent deck per image_order, built from the local
+# album index (see ALBUM SYNC). Each asset carries a sort key (its shuffle
+# rank for 'random', its capture date for 'newest') and a shown flag, so
+# picking the next photo is a single index lookup and album changes only
+# touch the assets that were added or removed. When every asset has been
+# shown a new round starts; 'random' reshuffles with the next epoch of the
+# seed, so a given seed always plays the same order.
+DECK_MODES = ('random', 'newest')
+DECK_ORDER = {
+    'random': 'sort_key, asset_id',
+    'newest': 'sort_key DESC, asset_id DESC',
+}
+UNKNOWN_CAPTURE_DATE = '1970-01-01T00:00:00'
+
+def shuffle_rank(seed, epoch, asset_id):
+    """Position of an asset in the shuffled deck of one round"""
+    return hashlib.sha256(f'{seed}:{epoch}:{asset_id}'.encode()).hexdigest()[:16]
+
+def deck_sort_key(mode, asset_id, taken_at, seed, epoch):
+    """Sort key of an asset in a deck"""
+    if mode == 'newest':
+        return taken_at or UNKNOWN_CAPTURE_DATE
+    return shuffle_rank(seed, epoch, asset_id)
+
+def start_deck_round(conn, album_id, mode, seed, epoch):
+    """Mark every asset unshown again (and reshuffle a random deck)"""
+    conn.execute(
+        'UPDATE deck_meta SET seed = ?, epoch = ? WHERE album_id = ? AND mode = ?',
+        (seed, epoch, album_id, mode)
+    )
+    if mode == 'random':
+        asset_ids = [row[0] for row in conn.execute(
+            'SELECT asset_id FROM deck WHERE album_id = ? AND mode = ?', (album_id, mode))]
+        conn.executemany(
+            'UPDATE deck SET sort_key = ?, shown = 0 WHERE album_id = ? AND mode = ? AND asset_id = ?',
+            [(shuffle_rank(seed, epoch, asset_id), album_id, mode, asset_id) for asset_id in asset_ids]
+        )
+    else:
+        conn.execute('UPDATE deck SET shown = 0 WHERE album_id = ? AND mode = ?', (album_id, mode))
+
+def load_deck_meta(conn, album_id, mode):
+    """
+    (seed, epoch, last_asset_id, album_revision) of a deck, created on first
+    use. The seed is the shuffle_seed option, or a random one kept in the
+    deck; changing the option restarts the deck with the new seed.
+    """
+    row = conn.execute(
+        'SELECT seed, epoch, last_asset_id, album_revision FROM deck_meta WHERE album_id = ? AND mode = ?',
+        (album_id, mode)
+    ).fetchone()
+    
+    if row is None:
+        seed = shuffle_seed or f'{random.getrandbits(64):016x}'
+        conn.execute(
+            'INSERT INTO deck_meta (album_id, mode, seed, epoch, album_revision) VALUES (?, ?, ?, 0, -1)',
+            (album_id, mode, seed)
+        )
+        return seed, 0, None, -1
+    
+    seed, epoch, last_asset_id, album_revision = row
+    if shuffle_seed and shuffle_seed != seed:
+        logger.info(f"Shuffle seed changed, restarting {mode} deck of album {album_id}")
+        seed, epoch = shuffle_seed, 0
+        start_deck_round(conn, album_id, mode, seed, epoch)
+    return seed, epoch, last_asset_id, album_revision
+
+def sync_deck(conn, album_id, mode, seed, epoch, revision):
+    """
+    Apply changes of the album index to a deck: add new assets as not yet
+    shown, drop removed ones and re-sort changed capture dates.
+    Returns (added, removed) counts.
+    """
+    added = conn.execute(
+        """SELECT a.asset_id, a.taken_at FROM album_assets a
+           LEFT JOIN deck d ON d.album_id = a.album_id AND d.mode = ? AND d.asset_id = a.asset_id
+           WHERE a.album_id = ? AND d.asset_id IS NULL""",
+        (mode, album_id)
+    ).fetchall()
+    conn.executemany(
+        'INSERT INTO deck (album_id, mode, asset_id, sort_key) VALUES (?, ?, ?, ?)',
+        [(album_id, mode, asset_id, deck_sort_key(mode, asset_id, taken_at, seed, epoch))
+         for asset_id, taken_at in added]
+    )
+    
+    removed = conn.execute(
+        """DELETE FROM deck WHERE album_id = ? AND mode = ? AND asset_id NOT IN
+           (SELECT asset_id FROM album_assets WHERE album_id = ?)""",
+        (album_id, mode, album_id)
+    ).rowcount
+    
+    if mode == 'newest':
+        conn.execute(
+            """UPDATE deck SET sort_key = (
+                   SELECT COALESCE(a.taken_at, ?) FROM album_assets a
+                   WHERE a.album_id = deck.album_id AND a.asset_id = deck.asset_id)
+               WHERE album_id = ? AND mode = ? AND sort_key IS NOT (
+                   SELECT COALESCE(a.taken_at, ?) FROM album_assets a
+                   WHERE a.album_id = deck.album_id AND a.asset_id = deck.asset_id)""",
+            (UNKNOWN_CAPTURE_DATE, album_id, mode, UNKNOWN_CAPTURE_DATE)
+        )
+    
+    conn.execute(
+        'UPDATE deck_meta SET album_revision = ? WHERE album_id = ? AND mode = ?',
+        (revision, album_id, mode)
+    )
+    if added or removed:
+        logger.info(f"Deck {mode} of album {album_id}: +{len(added)} -{removed} assets")
+    return len(added), removed
+
+def next_in_deck(conn, album_id, mode, count=1):
+    """Asset ids of the next unshown assets of the current round"""
+    return [row[0] for row in conn.execute(
+        f'SELECT asset_id FROM deck WHERE album_id = ? AND mode = ? AND shown = 0 '
+        f'ORDER BY {DECK_ORDER[mode]} LIMIT ?',
+        (album_id, mode, count)
+    )]
+
+def open_deck(conn, album_id, mode, revision):
+    """
+    Deck state (seed, epoch, last_asset_id), first applying album index
+    changes newer than the deck
+    """
+    seed, epoch, last_asset_id, album_revision = load_deck_meta(conn, album_id, mode)
+    if album_revision != revision:
+        sync_deck(conn, album_id, mode, seed, epoch, revision)
+    return seed, epoch, last_asset_id
+
+def draw_from_deck(album_id, mode, revision):
+    """
+    Take the next asset from a deck and mark it shown, starting a new round
+    when the deck is used up. Returns None for an empty deck.
+    """
+    with db_transaction() as conn:
+        seed, epoch, last_asset_id = open_deck(conn, album_id, mode, revision)
+        candidates = next_in_deck(conn, album_id, mode)
+        
+        if not candidates:
+            epoch += 1
+            start_deck_round(conn, album_id, mode, seed, epoch)
+            # Don't open the new round with the photo that ended the last one
+            candidates = [asset_id for asset_id in next_in_deck(conn, album_id, mode, 2)
+                          if asset_id != last_asset_id] or next_in_deck(conn, album_id, mode)
+            if not candidates:
+                return None
+            logger.info(f"Deck {mode} of album {album_id} exhausted, starting round {epoch}")
+        
+        asset_id = candidates[0]
+        conn.execute(
+            'UPDATE deck SET shown = 1 WHERE album_id = ? AND mode = ? AND asset_id = ?',
+            (album_id, mode, asset_id)
+        )
+        conn.execute(
+            'UPDATE deck_meta SET last_asset_id = ? WHERE album_id = ? AND mode = ?',
+            (asset_id, album_id, mode)
+        )
+    return asset_id
+
+def peek_deck(album_id, mode, count):
+    """The next count asset ids a deck will hand out (within the current round)"""
+    return next_in_deck(get_db(), album_id, mode, count)
+
+def deck_play_order(album_id, mode, revision, limit=None):
+    """
+    (asset_id, original_path) of every asset in the deck, in the order they
+    will be shown: the rest of the current round first, then the others.
+    """
+    with db_transaction() as conn:
+        open_deck(conn, album_id, mode, revision)
+        return conn.execute(
+            f"""SELECT asset_id, (SELECT original_path FROM album_assets a
+                                  WHERE a.album_id = deck.album_id AND a.asset_id = deck.asset_id)
+                FROM deck WHERE album_id = ? AND mode = ?
+                ORDER BY shown, {DECK_ORDER[mode]} LIMIT ?""",
+            (album_id, mode, limit or -1)
+        ).fetchall()
+
+# =============== REQUEST TIMING & PROFILING ===============
+PIPELINE_ENDPOINTS = ('main.process_and_download', 'main.prepare_photo')
+PROFILE_HEADER = 'X-EPF-Profile'
+profile_dir = os.path.join(photo_dir, 'debug')
+profile_lock = threading.Lock()
+
+def record_stage_timing(name, duration_ms):
+    """Collect a render stage for the Server-Timing header (background jobs only log it)"""
+    if has_request_context():
+        g.setdefault('stage_timings', []).append((name, duration_ms))
+
+render.set_hooks(stage=record_stage_timing, metric=record_metric)
+
+def format_server_timing(timings, total_ms=None):
+    """Build a Server-Timing header value from (name, duration_ms) pairs"""
+    entries = [f"{name};dur={duration_ms:.1f}" for name, duration_ms in timings]
+    if total_ms is not None:
+        entries.append(f"total;dur={total_ms:.1f}")
+    return ', '.join(entries)
+
+def is_ingress_request():
+    """True if the request came through the Home Assistant ingress gateway"""
+    orig = request.environ.get('werkzeug.proxy_fix.orig', {})
+    remote_addr = orig.get('REMOTE_ADDR', request.remote_addr)
+    return remote_addr == '172.30.32.2' and 'X-Ingress-Path' in request.headers
+
+def profiling_requested():
+    """Profile this request? Only pipeline endpoints, opt-in via header or config flag"""
+    if request.endpoint not in PIPELINE_ENDPOINTS:
+        return False
+    return debug_profiling or request.headers.get(PROFILE_HEADER) == '1'
+
+def start_request_profile():
+    """Start cProfile + tracemalloc for the current request (one at a time per worker)"""
+    if not profile_lock.acquire(blocking=False):
+        logger.info("Profiling already active, skipping this request")
+        return None
+
+    import cProfile
+    import tracemalloc
+
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_request_profile(profiler, title, timings, started):
+    """
+    Stop profiling and write the report to the debug directory. Runs when
+    the response was closed (see add_server_timing), after the request
+    context is gone, so the request details are passed in.
+    """
+    import pstats
+    import tracemalloc
+
+    try:
+        profiler.disable()
+        total_ms = (time.perf_counter() - started) * 1000
+        snapshot = tracemalloc.take_snapshot()
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        report = io.StringIO()
+        report.write(f"Request: {title}\n")
+        report.write(f"Captured: {datetime.now().isoformat()} (pid {os.getpid()})\n")
+        report.write(f"Server-Timing: {format_server_timing(timings)}\n")
+        report.write(f"Total including the response body: {total_ms:.1f}ms\n")
+        report.write(f"Memory: current={current_bytes / 1024:.0f}KB peak={peak_bytes / 1024:.0f}KB\n\n")
+
+        report.write("=== cProfile (top 40 by cumulative time) ===\n")
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats('cumulative').print_stats(40)
+
+        report.write("\n=== tracemalloc (top 20 allocations by line) ===\n")
+        for stat in snapshot.statistics('lineno')[:20]:
+            report.write(f"{stat}\n")
+
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_path = os.path.join(profile_dir, 'profile_latest.txt')
+        with open(profile_path, 'w') as f:
+            f.write(report.getvalue())
+        logger.info(f"Profile written: {profile_path}")
+    except Exception as e:
+        logger.error(f"Error writing profile: {e}")
+    finally:
+        profile_lock.release()
+
+# =============== FRAME DOWNLOAD ===============
+# The ESP32 asks for PackBits with the X-Frame-Encoding header (see
+# framecodec.py for the format), else it gets the hex text.
+FRAME_ENCODING_HEADER = 'X-Frame-Encoding'
+FRAME_ENCODINGS = ('hex', 'packbits')
+
+def send_frame(image):
+    """
+    Send a processed frame to the ESP32 in the encoding it asked for:
+    PackBits binary if X-Frame-Encoding: packbits, else the hex text format.
+    The frame is packed once (half a byte per pixel); hex is streamed from
+    the packed bytes with its Content-Length known up front.
+    """
+    encoding = request.headers.get(FRAME_ENCODING_HEADER, 'hex').strip().lower()
+    if encoding not in FRAME_ENCODINGS:
+        encoding = 'hex'
+    
+    raw_length = frame_size(image)
+    with timed_stage('pack'):
+        packed = pack_frame(image)
+    
+    if encoding == 'packbits':
+        with timed_stage('encode'):
+            payload = packbits_encode(packed)
+        payload_length = len(payload)
+        record_metric('frame_compression_ratio', raw_length / max(payload_length, 1))
+        response = send_file(
+            io.BytesIO(payload),
+            mimetype='application/octet-stream',
+            as_attachment=True,
+            download_name='frame.bin'
+        )
+    else:
+        payload_length = hex_frame_length(raw_length)
+        band_bytes = (image.width + 1) // 2 * FRAME_BAND_ROWS
+        
+        def generate():
+            started = time.perf_counter()
+            yield from iter_hex_frame(packed[i:i + band_bytes] for i in range(0, raw_length, band_bytes))
+            record_metric('frame_hex_stream_ms', (time.perf_counter() - started) * 1000)
+        
+        response = Response(generate(), mimetype='text/plain')
+        response.headers['Content-Disposition'] = 'attachment; filename=frame.txt'
+        response.headers['Content-Length'] = str(payload_length)
+    
+    record_metric(f'frame_{encoding}_bytes', payload_length)
+    logger.info(f"Frame encoded as {encoding}: {raw_length} -> {payload_length} bytes")
+    
+    response.headers[FRAME_ENCODING_HEADER] = encoding
+    response.headers['X-Frame-Raw-Length'] = str(raw_length)
+    response.vary.add(FRAME_ENCODING_HEADER)
+    return response
+
+# =============== FRAME STORAGE ===============
+# Every render is a generation directory frames/<frame_id>/ with the dithered
+# BMP and the original thumbnail (the processed JPEG preview is added on first
+# request). It is written under a temporary name and renamed into place, then
+# published by atomically replacing frames.json, which names the latest frame,
+# whether it still waits for delivery and the delivered frame. Readers only
+# read frames.json, so they always see one consistent state without locking;
+# writers serialize their read-modify-write on frames.lock. A generation that
+# is no longer referenced is deleted FRAME_GC_GRACE seconds later, so a reader
+# that resolved the previous state can still open its files.
+frames_dir = os.path.join(photo_dir, 'frames')
+frame_state_file = os.path.join(photo_dir, 'frames.json')
+frame_state_lock_file = os.path.join(photo_dir, 'frames.lock')
+FRAME_GC_GRACE = 60
+FRAME_TMP_GRACE = 600  # Unfinished generations (a render still running or crashed)
+LEGACY_FRAME_FILES = ('latest.frame', 'delivered.frame', 'latest.status')
+
+FRAME_FILES = {
+    'frame': '.bmp',
+    'original': '_original.jpg',
+    'processed': '_processed.jpg',
+}
+
+def generation_file(directory, variant='frame'):
+    """Path of one file in a generation directory"""
+    return os.path.join(directory, f"frame{FRAME_FILES[variant]}")
+
+def frame_path(frame_id, variant='frame'):
+    """Path of one file belonging to a published frame"""
+    return generation_file(os.path.join(frames_dir, frame_id), variant)
+
+def read_json_file(path, default=None):
+    """Read a JSON state file, default if missing or unreadable"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def write_json_file(path, data):
+    """Write a JSON state file atomically (readers never see a partial file)"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def new_frame_id():
+    """Unique, time-sortable id for a stored frame"""
+    return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+
+def read_frame_state():
+    """Published frame state: latest, status ('new' or 'delivered'), delivered"""
+    return read_json_file(frame_state_file, {})
+
+@contextmanager
+def frame_state_update():
+    """
+    Exclusive read-modify-write of the frame state: yields the state to
+    change and publishes it with one atomic replace when the block succeeds.
+    """
+    os.makedirs(photo_dir, exist_ok=True)
+    with open(frame_state_lock_file, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_frame_state()
+        referenced = {state.get('latest'), state.get('delivered')}
+        yield state
+        state['updated_at'] = time.time()
+        write_json_file(frame_state_file, state)
+    
+    # Start the grace period of generations that just became unreferenced
+    for frame_id in referenced - {state.get('latest'), state.get('delivered'), None}:
+        try:
+            os.utime(os.path.join(frames_dir, frame_id))
+        except OSError:
+            pass
+
+@contextmanager
+def new_generation():
+    """Temporary directory for a new frame's files, renamed to frames/<frame_id> when the block succeeds"""
+    frame_id = new_frame_id()
+    tmp_dir = os.path.join(frames_dir, f".{frame_id}.tmp")
+    os.makedirs(tmp_dir)
+    try:
+        yield frame_id, tmp_dir
+        os.rename(tmp_dir, os.path.join(frames_dir, frame_id))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+def save_frame(image_original, settings):
+    """
+    Render image_original with the given render settings for the ESP32 and
+    store it as a new (unpublished) generation. Only the dithered BMP and the original thumbnail are written
+    here; the processed JPEG preview is created on first request.
+    Returns (frame_id, processed image).
+    """
+    with new_generation() as (frame_id, directory):
+        # 1. Original unprocessed (only resized to fit display)
+        with timed_stage('save-original'):
+            original_thumbnail(image_original).save(generation_file(directory, 'original'), 'JPEG', quality=85)
+        
+        # 2. Processed with rotation + dithering for ESP32
+        processed_rotated = scale_img_in_memory(image_original, settings)
+        
+        with timed_stage('save'):
+            processed_rotated.save(generation_file(directory, 'frame'), 'BMP')
+    
+    logger.info(f"Saved frame {frame_id}")
+    return frame_id, processed_rotated
+
+def publish_frame(frame_id, delivered=False):
+    """
+    Make a saved frame the latest one, either waiting for delivery
+    (/prepare-photo) or already delivered (rendered on the fly by /download).
+    A delivered frame never replaces one that is still waiting.
+    """
+    with frame_state_update() as state:
+        if delivered:
+            state['delivered'] = frame_id
+            if state.get('status') != 'new':
+                state['latest'] = frame_id
+                state['status'] = 'delivered'
+        else:
+            state['latest'] = frame_id
+            state['status'] = 'new'
+    remove_stale_frames()
+
+def claim_pending_frame():
+    """
+    Mark the frame waiting for delivery as delivered and return its id, None
+    if there is none. Of concurrent callers only one gets the frame.
+    """
+    with frame_state_update() as state:
+        frame_id = state.get('latest')
+        if state.get('status') == 'new' and frame_id and os.path.exists(frame_path(frame_id)):
+            state['status'] = 'delivered'
+            state['delivered'] = frame_id
+        else:
+            frame_id = None
+    remove_stale_frames()
+    return frame_id
+
+def remove_stale_frames():
+    """Delete generations that are neither the latest nor the delivered frame, after their grace period"""
+    state = read_frame_state()
+    keep = {state.get('latest'), state.get('delivered')}
+    now = time.time()
+    try:
+        for entry in os.scandir(frames_dir):
+            if entry.name in keep:
+                continue
+            grace = FRAME_TMP_GRACE if entry.name.startswith('.') else FRAME_GC_GRACE
+            if now - entry.stat().st_mtime < grace:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+    except OSError as e:
+        logger.warning(f"Error cleaning up frames: {e}")
+
+def get_preview_path(frame_id, variant):
+    """
+    Path of a preview file for frame_id, creating the processed JPEG
+    from the cached frame on first use. None if the frame is gone.
+    """
+    if not frame_id:
+        return None
+    
+    path = frame_path(frame_id, variant)
+    if os.path.exists(path):
+        return path
+    
+    if variant != 'processed' or not os.path.exists(frame_path(frame_id)):
+        return None
+    
+    # Write under a temporary name so concurrent requests never see a partial JPEG
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with Image.open(frame_path(frame_id)) as frame:
+            frame.convert('RGB').save(tmp_path, 'JPEG', quality=90)
+        os.replace(tmp_path, path)
+    except OSError:
+        return None  # Generation removed meanwhile
+    logger.info(f"Created processed preview for frame {frame_id}")
+    return path
+
+def send_preview(frame_id, variant, missing_message):
+    """Send a preview image with ETag/Last-Modified so browsers can revalidate (304)"""
+    path = get_preview_path(frame_id, variant)
+    if not path:
+        return jsonify({'error': missing_message}), 404
+    return send_file(
+        path,
+        mimetype='image/jpeg',
+        etag=f"{frame_id}-{variant}",
+        conditional=True,
+        max_age=0
+    )
+
+# =============== ALBUM SYNC ===============
+# Local index of the album's assets (id, path, capture date) in epf.db, so a
+# request never parses the full album JSON. A sync first fetches the album
+# without its assets; only when its version (updatedAt/assetCount) changed are
+# the assets paged through /api/search/metadata and diffed by id. Otherwise
+# just the assets modified since the last sync are fetched. Requests within
+# ALBUM_SYNC_INTERVAL seconds of a sync use the index without asking Immich.
+ALBUM_SYNC_INTERVAL = int(os.getenv('ALBUM_SYNC_INTERVAL', '60'))
+ALBUM_SYNC_PAGE_SIZE = 1000
+album_sync_lock = threading.Lock()
+
+class AssetSearchUnavailable(Exception):
+    """Raised when Immich does not support the metadata search used for paging"""
+
+def compact_asset(item):
+    """(asset_id, original_path, taken_at, updated_at) of an Immich asset"""
+    exif = item.get('exifInfo') or {}
+    return (
+        item['id'],
+        item.get('originalPath', ''),
+        exif.get('dateTimeOriginal') or item.get('fileCreatedAt'),
+        item.get('updatedAt'),
+    )
+
+def album_version(album):
+    """
+    Fingerprint of an album that changes when assets are added or removed.
+    lastModifiedAssetTimestamp is left out: it moves with every edit of a
+    single asset, which the delta sync handles.
+    """
+    return '|'.join(str(album.get(key)) for key in ('updatedAt', 'assetCount'))
+
+def fetch_album(name, album_id=None):
+    """Album info without assets, by the cached id if it still has this name"""
+    if album_id:
+        response = requests.get(f'{url}/api/albums/{album_id}', params={'withoutAssets': 'true'},
+                                headers=headers, timeout=10)
+        if response.status_code == 200 and response.json().get('albumName') == name:
+            return response.json()
+    
+    response = requests.get(f'{url}/api/albums', headers=headers, timeout=10)
+    if response.status_code != 200:
+        raise PhotoFetchError(f'Failed to fetch albums: {response.status_code}')
+    
+    album = next((item for item in response.json() if item.get('albumName') == name), None)
+    if not album:
+        raise PhotoFetchError(f'Album {name} not found', 404)
+    return album
+
+def search_album_assets(album_id, **filters):
+    """Yield an album's assets page by page (compact, without EXIF)"""
+    page = 1
+    while page:
+        response = requests.post(
+            f'{url}/api/search/metadata',
+            headers=headers,
+            json={'albumIds': [album_id], 'page': page, 'size': ALBUM_SYNC_PAGE_SIZE, 'withExif': False, **filters},
+            timeout=30
+        )
+        if response.status_code in (400, 404):
+            raise AssetSearchUnavailable(f'Asset search returned {response.status_code}')
+        if response.status_code != 200:
+            raise PhotoFetchError(f'Failed to fetch album assets: {response.status_code}')
+        
+        result = response.json().get('assets') or {}
+        yield [compact_asset(item) for item in result.get('items', [])]
+        page = result.get('nextPage')
+
+def store_album_assets(conn, album_id, assets, revision):
+    """Insert or update compact assets in the album index"""
+    conn.executemany(
+        """INSERT INTO album_assets (album_id, asset_id, original_path, taken_at, updated_at, revision)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT(album_id, asset_id) DO UPDATE SET
+               original_path = excluded.original_path,
+               taken_at = excluded.taken_at,
+               updated_at = excluded.updated_at,
+               revision = excluded.revision""",
+        [(album_id, *asset, revision) for asset in assets]
+    )
+
+def full_album_sync(album_id, revision, asset_count=None):
+    """
+    List every asset of the album into the index and drop the ones that are
+    no longer in it. Uses the full album response on servers without asset
+    search, or whose search returns more than the album's asset_count (the
+    album filter was ignored). Returns the number of assets.
+    """
+    count = 0
+    try:
+        for assets in search_album_assets(album_id):
+            count += len(assets)
+            if asset_count is not None and count > asset_count:
+                raise AssetSearchUnavailable(f'Asset search returned more than the album\'s {asset_count} assets')
+            with db_transaction() as conn:
+                store_album_assets(conn, album_id, assets, revision)
+    except AssetSearchUnavailable as e:
+        logger.info(f"{e}, syncing album from the full album response")
+        response = requests.get(f'{url}/api/albums/{album_id}', headers=headers, timeout=30)
+        if response.status_code != 200:
+            raise PhotoFetchError('Failed to fetch album assets')
+        assets = [compact_asset(item) for item in response.json().get('assets', [])]
+        with db_transaction() as conn:
+            # Drop whatever the paged search stored in this pass
+            conn.execute('DELETE FROM album_assets WHERE album_id = ? AND revision = ?', (album_id, revision))
+            store_album_assets(conn, album_id, assets, revision)
+        count = len(assets)
+    
+    with db_transaction() as conn:
+        conn.execute('DELETE FROM album_assets WHERE album_id = ? AND revision < ?', (album_id, revision))
+    return count
+
+def delta_album_sync(album_id, revision):
+    """Update assets modified since the last sync. Returns the number changed."""
+    conn = get_db()
+    since = conn.execute('SELECT MAX(updated_at) FROM album_assets WHERE album_id = ?', (album_id,)).fetchone()[0]
+    if since is None:
+        return 0
+    
+    # updatedAfter is inclusive; step past the newest known change
+    try:
+        since = (datetime.fromisoformat(since) + timedelta(milliseconds=1)).isoformat()
+    except ValueError:
+        pass
+    
+    changed = []
+    try:
+        for assets in search_album_assets(album_id, updatedAfter=since):
+            for asset in assets:
+                stored = conn.execute(
+                    'SELECT original_path, taken_at, updated_at FROM album_assets WHERE album_id = ? AND asset_id = ?',
+                    (album_id, asset[0])
+                ).fetchone()
+                # New assets change the album version (full sync); anything
+                # else not indexed is outside the album
+                if stored is not None and stored != asset[1:]:
+                    changed.append(asset)
+    except AssetSearchUnavailable:
+        return 0
+    
+    if changed:
+        with db_transaction() as conn:
+            store_album_assets(conn, album_id, changed, revision)
+    return len(changed)
+
+def sync_album(name):
+    """
+    Bring the local index of the named album up to date (see above) and
+    return (album_id, revision). The revision changes whenever the indexed
+    assets do. Falls back to the existing index if Immich fails.
+    """
+    with album_sync_lock:
+        row = get_db().execute(
+            'SELECT album_id, album_version, revision, synced_at FROM album_sync WHERE album_name = ?',
+            (name,)
+        ).fetchone()
+        if row and time.time() - (row[3] or 0) < ALBUM_SYNC_INTERVAL:
+            return row[0], row[2]
+        
+        started = time.perf_counter()
+        try:
+            album = fetch_album(name, row[0] if row else None)
+            album_id = album['id']
+            version = album_version(album)
+            revision = row[2] if row else 0
+            
+            if row is None or row[0] != album_id or row[1] != version:
+                revision += 1
+                count = full_album_sync(album_id, revision, album.get('assetCount'))
+                kind = 'full'
+                logger.info(f"Album {name} synced: {count} assets")
+            else:
+                if delta_album_sync(album_id, revision + 1):
+                    revision += 1
+                kind = 'delta'
+        except requests.RequestException as e:
+            if row is None:
+                raise ImmichUnavailable(f'Failed to reach Immich: {e}')
+            logger.warning(f"Album sync failed, using the local index: {e}")
+            return row[0], row[2]
+        except PhotoFetchError as e:
+            if row is None or e.status_code == 404:
+                raise
+            logger.warning(f"Album sync failed, using the local index: {e}")
+            return row[0], row[2]
+        
+        with db_transaction() as conn:
+            conn.execute(
+                """INSERT INTO album_sync (album_name, album_id, album_version, revision, synced_at)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(album_name) DO UPDATE SET
+                       album_id = excluded.album_id,
+                       album_version = excluded.album_version,
+                       revision = excluded.revision,
+                       synced_at = excluded.synced_at""",
+                (name, album_id, version, revision, time.time())
+            )
+        record_metric(f'album_sync_{kind}_ms', (time.perf_counter() - started) * 1000)
+        return album_id, revision
+
+def expire_album_sync(name):
+    """Make the next request sync the album again (e.g. after a vanished asset)"""
+    get_db().execute('UPDATE album_sync SET synced_at = 0 WHERE album_name = ?', (name,))
+
+def album_asset_path(album_id, asset_id):
+    """originalPath of an indexed asset"""
+    row = get_db().execute(
+        'SELECT original_path FROM album_assets WHERE album_id = ? AND asset_id = ?',
+        (album_id, asset_id)
+    ).fetchone()
+    return row[0] if row else ''
+
+# =============== LOCAL FOLDER SOURCE ===============
+# With photo_source 'folder' the photos come from local_folder (e.g. a Home
+# Assistant media share) instead of Immich. The folder is indexed in
+# folder_files (path, mtime, size, EXIF date, dimensions) and mirrored into
+# album_assets under the album id 'folder:<path>', so decks, the caches and
+# the render pipeline treat it like an Immich album. A background watcher
+# reconciles the index with the disk once at start and every
+# FOLDER_RESCAN_INTERVAL seconds (only new or changed files are probed), and
+# in between applies watchdog events for just the paths that changed. Network
+# shares that deliver no events are covered by the periodic rescan.
+LOCAL_ASSET_PREFIX = 'local-'
+PHOTO_EXTENSIONS = tuple(ALLOWED_EXTENSIONS)
+FOLDER_RESCAN_INTERVAL = int(os.getenv('FOLDER_RESCAN_INTERVAL', '3600'))
+FOLDER_EVENT_DELAY = 2
+FOLDER_INDEX_BATCH = 500
+
+def folder_album_id(folder):
+    """Album id (and album_sync name) of a folder's index"""
+    return f"folder:{folder}"
+
+def local_asset_id(path):
+    """Asset id of a file, from its path relative to the folder"""
+    return LOCAL_ASSET_PREFIX + hashlib.sha1(path.encode()).hexdigest()[:20]
+
+def is_hidden(name):
+    """Dot files and NAS system folders (@eaDir, #recycle) are not indexed"""
+    return name.startswith(('.', '@', '#'))
+
+def below_pattern(path):
+    """LIKE pattern (ESCAPE '\\') for everything below a relative directory path"""
+    return path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + os.sep + '%'
+
+def walk_photos(folder, subdir=''):
+    """Yield (relative path, (mtime, size)) of every photo below folder/subdir"""
+    pending = [os.path.join(folder, subdir) if subdir else folder]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError as e:
+            logger.warning(f"Cannot read {e.filename}: {e.strerror}")
+            continue
+        for entry in entries:
+            if is_hidden(entry.name):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.lower().endswith(PHOTO_EXTENSIONS):
+                    stat = entry.stat()
+                    yield os.path.relpath(entry.path, folder), (stat.st_mtime, stat.st_size)
+            except OSError:
+                continue
+
+def probe_photo(full_path):
+    """(taken_at, width, height) from a photo's header and EXIF, without decoding it"""
+    if full_path.lower().endswith(RAW_EXTENSIONS):
+        return None, None, None
+    if full_path.lower().endswith(('.heic', '.heif')):
+        ensure_heif_opener()
+    
+    try:
+        with Image.open(full_path) as image:
+            width, height = image.size
+            exif = image.getexif()
+            taken = exif.get_ifd(ExifTags.IFD.Exif).get(36867) or exif.get(306)
+    except Exception:
+        return None, None, None
+    
+    try:
+        taken_at = datetime.strptime(str(taken).strip(), '%Y:%m:%d %H:%M:%S').isoformat()
+    except ValueError:
+        taken_at = None
+    return taken_at, width, height
+
+def index_entry(folder, path, mtime, size):
+    """Index row of one file (capture date falls back to the file's mtime)"""
+    taken_at, width, height = probe_photo(os.path.join(folder, path))
+    taken_at = taken_at or datetime.fromtimestamp(mtime).isoformat(timespec='seconds')
+    return path, local_asset_id(path), mtime, size, taken_at, width, height
+
+def store_folder_entries(folder, entries, removed=()):
+    """
+    Write probed files and drop removed paths (files or whole directories)
+    from the folder index; the album revision moves on if anything changed.
+    """
+    album_id = folder_album_id(folder)
+    with db_transaction() as conn:
+        row = conn.execute('SELECT revision FROM album_sync WHERE album_name = ?', (album_id,)).fetchone()
+        revision = row[0] if row else 0
+        if entries or removed:
+            revision += 1
+        
+        conn.executemany(
+            """INSERT OR REPLACE INTO folder_files (folder, path, asset_id, mtime, size, taken_at, width, height)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            [(folder, *entry) for entry in entries]
+        )
+        store_album_assets(conn, album_id, [
+            (asset_id, os.path.join(folder, path), taken_at, datetime.fromtimestamp(mtime).isoformat())
+            for path, asset_id, mtime, size, taken_at, width, height in entries
+        ], revision)
+        
+        for path in removed:
+            asset_ids = conn.execute(
+                "SELECT asset_id FROM folder_files WHERE folder = ? AND (path = ? OR path LIKE ? ESCAPE '\\')",
+                (folder, path, below_pattern(path))
+            ).fetchall()
+            conn.executemany('DELETE FROM folder_files WHERE folder = ? AND asset_id = ?',
+                             [(folder, asset_id) for (asset_id,) in asset_ids])
+            conn.executemany('DELETE FROM album_assets WHERE album_id = ? AND asset_id = ?',
+                             [(album_id, asset_id) for (asset_id,) in asset_ids])
+        
+        conn.execute(
+            """INSERT INTO album_sync (album_name, album_id, revision, synced_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT(album_name) DO UPDATE SET
+                   revision = excluded.revision,
+                   synced_at = excluded.synced_at""",
+            (album_id, album_id, revision, time.time())
+        )
+
+def reconcile_folder(folder, subdir=''):
+    """
+    Bring the index of folder (or one subdirectory) in line with the disk:
+    probe new and changed files, drop vanished ones. A missing folder (e.g.
+    an unmounted share) leaves the index alone. Returns the number of changes.
+    """
+    if not os.path.isdir(folder):
+        logger.warning(f"Photo folder {folder} not found, keeping its index")
+        return 0
+    
+    on_disk = dict(walk_photos(folder, subdir))
+    if subdir:
+        rows = get_db().execute(
+            "SELECT path, mtime, size FROM folder_files WHERE folder = ? AND path LIKE ? ESCAPE '\\'",
+            (folder, below_pattern(subdir))
+        )
+    else:
+        rows = get_db().execute('SELECT path, mtime, size FROM folder_files WHERE folder = ?', (folder,))
+    indexed = {path: (mtime, size) for path, mtime, size in rows}
+    
+    changed = [path for path, stat in on_disk.items() if indexed.get(path) != stat]
+    removed = [path for path in indexed if path not in on_disk]
+    
+    # Batches keep each write transaction short and make a first index usable early
+    store_folder_entries(folder, [], removed)
+    for start in range(0, len(changed), FOLDER_INDEX_BATCH):
+        store_folder_entries(folder, [index_entry(folder, path, *on_disk[path])
+                                      for path in changed[start:start + FOLDER_INDEX_BATCH]])
+    return len(changed) + len(removed)
+
+def index_paths(folder, paths):
+    """Update the folder index for paths reported by watchdog. Returns the number of changes."""
+    entries, removed, changes = [], [], 0
+    for full_path in paths:
+        path = os.path.relpath(full_path, folder)
+        if path.startswith('..') or any(is_hidden(part) for part in path.split(os.sep)):
+            continue
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            removed.append(path)
+            continue
+        except OSError:
+            continue
+        
+        if os.path.isdir(full_path):
+            changes += reconcile_folder(folder, path)
+        elif path.lower().endswith(PHOTO_EXTENSIONS):
+            row = get_db().execute('SELECT mtime, size FROM folder_files WHERE folder = ? AND path = ?',
+                                   (folder, path)).fetchone()
+            if row != (stat.st_mtime, stat.st_size):
+                entries.append(index_entry(folder, path, stat.st_mtime, stat.st_size))
+    
+    if entries or removed:
+        store_folder_entries(folder, entries, removed)
+    return changes + len(entries) + len(removed)
+
+def start_folder_observer(folder, pending, pending_lock):
+    """
+    Watch folder recursively and collect the paths of changes in pending.
+    Returns the observer, None if the folder cannot be watched.
+    """
+    started = time.perf_counter()
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    record_lazy_import('watchdog', started)
+    
+    class FolderEventHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            # A directory's own mtime changes with every file added to it
+            if event.event_type in ('opened', 'closed_no_write') or (event.is_directory and event.event_type == 'modified'):
+                return
+            with pending_lock:
+                pending.add(event.src_path)
+                if getattr(event, 'dest_path', ''):
+                    pending.add(event.dest_path)
+    
+    observer = Observer()
+    observer.daemon = True
+    try:
+        observer.schedule(FolderEventHandler(), folder, recursive=True)
+        observer.start()
+    except OSError as e:
+        logger.warning(f"Cannot watch {folder} ({e}), relying on the rescan every {FOLDER_RESCAN_INTERVAL}s")
+        return None
+    logger.info(f"Watching photo folder {folder}")
+    return observer
+
+def run_folder_watcher():
+    """Keep the index of the configured photo folder current (see above)"""
+    observer = None
+    watched = None
+    pending = set()
+    pending_lock = threading.Lock()
+    next_rescan = 0
+    
+    while not background_stop.is_set():
+        try:
+            if config_handler is not None:
+                config_handler.reload_if_changed()
+            
+            folder = local_folder if photo_source == 'folder' else None
+            if folder != watched:
+                if observer is not None:
+                    observer.stop()
+                    observer = None
+                watched, next_rescan = folder, 0
+            
+            if watched:
+                if observer is None and os.path.isdir(watched):
+                    observer = start_folder_observer(watched, pending, pending_lock)
+                
+                if time.time() >= next_rescan:
+                    next_rescan = time.time() + FOLDER_RESCAN_INTERVAL
+                    with pending_lock:
+                        pending.clear()
+                    started = time.perf_counter()
+                    changes = reconcile_folder(watched)
+                    duration_ms = (time.perf_counter() - started) * 1000
+                    record_metric('folder_scan_ms', duration_ms)
+                    logger.info(f"Photo folder {watched} scanned in {duration_ms:.0f}ms, {changes} changes")
+                else:
+                    with pending_lock:
+                        paths = set(pending)
+                        pending.clear()
+                    if paths:
+                        changes = index_paths(watched, paths)
+                        if changes:
+                            logger.info(f"Photo folder {watched}: {changes} changes from file events")
+        except Exception as e:
+            logger.error(f"Folder watcher error: {e}", exc_info=True)
+        
+        background_stop.wait(FOLDER_EVENT_DELAY)
+    
+    if observer is not None:
+        observer.stop()
+
+def folder_index(folder):
+    """(album_id, revision) of a folder's index"""
+    album_id = folder_album_id(folder)
+    row = get_db().execute('SELECT revision FROM album_sync WHERE album_name = ?', (album_id,)).fetchone()
+    if row is None:
+        raise PhotoFetchError('The photo folder is still being indexed', 503)
+    return album_id, row[0]
+
+def get_folder_stats():
+    """Indexed files and last index update of the photo folder for /health"""
+    files = get_db().execute('SELECT COUNT(*) FROM folder_files WHERE folder = ?', (local_folder,)).fetchone()[0]
+    row = get_db().execute('SELECT synced_at FROM album_sync WHERE album_name = ?',
+                           (folder_album_id(local_folder),)).fetchone()
+    return {
+        'path': local_folder,
+        'available': os.path.isdir(local_folder),
+        'files': files,
+        'indexed_age_seconds': round(time.time() - row[0], 1) if row and row[0] else None,
+    }
+
+# =============== IMMICH PHOTO FETCHING ===============
+class PhotoFetchError(Exception):
+    """Raised when no photo could be fetched from Immich"""
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ImmichUnavailable(PhotoFetchError):
+    """Raised when Immich cannot be reached (network error or server error)"""
+    def __init__(self, message):
+        super().__init__(message, 503)
+
+def current_album():
+    """
+    (album_id, revision) of the configured photo source: the local folder
+    index or the synced Immich album.
+    """
+    if photo_source == 'folder':
+        if not local_folder:
+            raise PhotoFetchError('Photo folder not configured')
+        return folder_index(local_folder)
+    
+    if not url or not album_name:
+        raise PhotoFetchError('Immich not configured')
+    
+    if not api_key:
+        raise PhotoFetchError('IMMICH_API_KEY not configured')
+    
+    return sync_album(album_name)
+
+def select_next_asset():
+    """
+    Sync the configured album and take the next asset from its deck.
+    Returns (asset_id, original_path).
+    """
+    with timed_stage('folder-index' if photo_source == 'folder' else 'immich-album'):
+        album_id, revision = current_album()
+    
+    with timed_stage('select'):
+        # Select image from the album's persistent deck
+        mode = image_order if image_order in DECK_MODES else 'random'
+        asset_id = draw_from_deck(album_id, mode, revision)
+        if asset_id is None:
+            raise PhotoFetchError('No images in album', 404)
+        return asset_id, album_asset_path(album_id, asset_id)
+
+def download_asset(asset_id):
+    """Download the original file of an asset from Immich"""
+    try:
+        response = requests.get(
+            f'{url}/api/assets/{asset_id}/original',
+            headers=headers,
+            stream=True,
+            timeout=30
+        )
+        
+        if response.status_code == 404:
+            expire_album_sync(album_name)
+        if response.status_code >= 500:
+            raise ImmichUnavailable(f'Immich answered HTTP {response.status_code}')
+        if response.status_code != 200:
+            raise PhotoFetchError('Failed to download image')
+        
+        return response.content
+    except requests.RequestException as e:
+        raise ImmichUnavailable(f'Failed to reach Immich: {e}')
+
+def fetch_original(asset_id, original_path):
+    """Original file of an asset: read from the photo folder, or downloaded from Immich"""
+    if not asset_id.startswith(LOCAL_ASSET_PREFIX):
+        return download_asset(asset_id)
+    try:
+        with open(original_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        raise PhotoFetchError('Photo no longer in the folder', 404)
+
+def prepare_next_frame():
+    """
+    Select the next asset and store its frame. While Immich is unreachable
+    the photo is picked from the source cache instead (offline mode).
+    Shared by /download and /prepare-photo. Returns (asset_id, frame_id, processed image).
+    """
+    if photo_source == 'folder' or not immich_unreachable():
+        try:
+            return prepare_frame(*select_next_asset())
+        except ImmichUnavailable as e:
+            if not source_cache_budget():
+                raise
+            logger.warning(f"{e}, showing a cached photo instead")
+    
+    asset_id, original_path = select_offline_asset()
+    record_metric('offline_selections')
+    logger.info(f"Offline mode: showing cached photo {asset_id}")
+    return prepare_frame(asset_id, original_path)
+
+def prepare_frame(asset_id, original_path):
+    """
+    Store the frame of an asset, taken from the frame cache when it was
+    pre-rendered with the current settings. Returns (asset_id, frame_id, processed image).
+    """
+    settings = render_settings()
+    cached = save_cached_frame(asset_id, render_settings_key(settings))
+    if cached:
+        record_metric('frame_cache_hits')
+        return (asset_id, *cached)
+    record_metric('frame_cache_misses')
+    
+    return (asset_id, *save_frame(load_source_image(asset_id, original_path, settings), settings))
+
+# =============== SOURCE CACHE ===============
+# Panel-sized copies of downloaded photos under sources/<asset_id>.jpg: the
+# short side is reduced to SOURCE_CACHE_SIDE (render.py), enough for fill and
+# fit in both panel orientations, and the EXIF data (orientation, date) is
+# kept, so a copy renders like its original. They are indexed by last use
+# in the source_cache table and the least recently used are evicted beyond
+# the source_cache_size budget (MB). Repeat renders read the copy instead of
+# downloading the original again, and while Immich is unreachable the next
+# photo is picked from the cached ones.
+source_dir = os.path.join(photo_dir, 'sources')
+
+def source_cache_budget():
+    """Byte budget of the source cache (0 disables it)"""
+    size_mb = current_config['immich'].get('source_cache_size', DEFAULT_CONFIG['immich']['source_cache_size'])
+    return max(size_mb, 0) * 1024 * 1024
+
+def source_cache_path(asset_id):
+    """File of an asset's cached copy"""
+    return os.path.join(source_dir, f"{asset_id}.jpg")
+
+def read_source_data(asset_id):
+    """Bytes of an asset's cached copy (marked as used), None if not cached"""
+    if not source_cache_budget():
+        return None
+    try:
+        with open(source_cache_path(asset_id), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    get_db().execute('UPDATE source_cache SET last_used = ? WHERE asset_id = ?', (time.time(), asset_id))
+    return data
+
+def store_source(asset_id, original_path, image, budget):
+    """Keep a panel-sized copy of a decoded Immich asset in the source cache"""
+    if not budget or asset_id.startswith(LOCAL_ASSET_PREFIX):
+        return
+    size = save_source_copy(image, source_cache_path(asset_id))
+    if size is not None:
+        register_source(asset_id, original_path, size, budget)
+
+def register_source(asset_id, original_path, size, budget):
+    """Index a saved source copy and evict the least recently used beyond budget"""
+    with db_transaction() as conn:
+        conn.execute(
+            """INSERT INTO source_cache (asset_id, original_path, bytes, last_used)
+               VALUES (?, ?, ?, ?)
+               ON CONFLICT(asset_id) DO UPDATE SET
+                   original_path = excluded.original_path,
+                   bytes = excluded.bytes,
+                   last_used = excluded.last_used""",
+            (asset_id, original_path, size, time.time())
+        )
+        total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM source_cache').fetchone()[0]
+        evicted = []
+        for victim, victim_size in conn.execute(
+                'SELECT asset_id, bytes FROM source_cache WHERE asset_id != ? ORDER BY last_used',
+                (asset_id,)).fetchall():
+            if total <= budget:
+                break
+            evicted.append(victim)
+            total -= victim_size
+        conn.executemany('DELETE FROM source_cache WHERE asset_id = ?', [(victim,) for victim in evicted])
+    
+    for victim in evicted:
+        try:
+            os.remove(source_cache_path(victim))
+        except FileNotFoundError:
+            pass
+        record_metric('source_cache_evictions')
+
+def load_source_image(asset_id, original_path, settings):
+    """
+    Decoded image of an asset: its cached copy, else the original downloaded
+    from Immich (then cached). Photos of the local folder are always read
+    from disk and don't take up the source cache.
+    """
+    local = asset_id.startswith(LOCAL_ASSET_PREFIX)
+    budget = 0 if local else source_cache_budget()
+    if budget:
+        with timed_stage('source-cache'):
+            data = read_source_data(asset_id)
+            image = decode_image(io.BytesIO(data), source_cache_path(asset_id), settings) if data else None
+        if image is not None:
+            record_metric('source_cache_hits')
+            return image
+        record_metric('source_cache_misses')
+    
+    with timed_stage('folder-read' if local else 'immich-download'):
+        image_data = io.BytesIO(fetch_original(asset_id, original_path))
+    
+    with timed_stage('decode'):
+        image = decode_image(image_data, original_path, settings)
+    
+    if budget:
+        with timed_stage('source-store'):
+            store_source(asset_id, original_path, image, budget)
+    return image
+
+def immich_unreachable():
+    """True while the health prober finds Immich unreachable"""
+    state = read_json_file(health_state_file)
+    if not state or time.time() - state['checked_at'] > 2 * HEALTH_PROBE_MAX_INTERVAL:
+        return False
+    return not state['reachable']
+
+def select_offline_asset():
+    """
+    Least recently used photo of the source cache (of the configured album
+    if it is indexed), marked as used. Returns (asset_id, original_path).
+    """
+    if not source_cache_budget():
+        raise ImmichUnavailable('Immich unreachable and the source cache is disabled')
+    
+    with timed_stage('select'):
+        with db_transaction() as conn:
+            row = conn.execute('SELECT album_id FROM album_sync WHERE album_name = ?', (album_name,)).fetchone()
+            if row:
+                candidate = conn.execute(
+                    """SELECT s.asset_id, s.original_path FROM source_cache s
+                       JOIN album_assets a ON a.asset_id = s.asset_id AND a.album_id = ?
+                       ORDER BY s.last_used LIMIT 1""",
+                    (row[0],)
+                ).fetchone()
+            else:
+                candidate = conn.execute(
+                    'SELECT asset_id, original_path FROM source_cache ORDER BY last_used LIMIT 1'
+                ).fetchone()
+            if candidate is None:
+                raise ImmichUnavailable('Immich unreachable and no photos cached')
+            conn.execute('UPDATE source_cache SET last_used = ? WHERE asset_id = ?', (time.time(), candidate[0]))
+    return candidate
+
+def get_source_cache_stats():
+    """Entries and size of the source cache for /health"""
+    entries, size = get_db().execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM source_cache').fetchone()
+    return {'entries': entries, 'bytes': size, 'budget_bytes': source_cache_budget()}
+
+# =============== FRAME CACHE ===============
+# Pre-rendered frames per asset under cache/<settings key>/, filled by the
+# pre-render job and used by /download and /prepare-photo before rendering
+# anything themselves. The key hashes every option that changes the render
+# (and the build), so a settings change never serves an outdated frame.
+cache_dir = os.path.join(photo_dir, 'cache')
+
+def render_settings():
+    """The options that affect how a frame is rendered"""
+    return {
+        'rotation': rotation_angle,
+        'enhanced': img_enhanced,
+        'contrast': img_contrast,
+        'strength': strength,
+        'display_mode': display_mode,
+        'dithering_method': dithering_method,
+        'dithering_space': dithering_space,
+        'raw_strategy': raw_strategy,
+        'date_position': date_position,
+        'date_size': date_size,
+        'date_format': date_format,
+    }
+
+def render_settings_key(settings):
+    """Short hash of the render settings, naming their cache directory"""
+    payload = json.dumps({'build': BUILD_VERSION, **settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()[:12]
+
+def cached_frame_path(key, asset_id, variant='frame'):
+    """Path of a pre-rendered frame file (FRAME_FILES variants)"""
+    return os.path.join(cache_dir, key, f"{asset_id}{FRAME_FILES[variant]}")
+
+def remove_stale_cache(key):
+    """Delete cached frames rendered with other settings than key"""
+    try:
+        for name in os.listdir(cache_dir):
+            if name != key:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+    except OSError as e:
+        logger.warning(f"Error cleaning up frame cache: {e}")
+
+def render_pool(workers):
+    """
+    Process pool for renders. Spawned (not forked), since the caller runs next
+    to other threads; the workers only import render.py, not the app.
+    """
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=render.init_worker, initargs=(LOG_LEVEL,))
+
+def render_into_cache(pool, asset_id, image_data, original_path, settings, source_budget=0):
+    """
+    Decode and render one downloaded asset into the frame cache in a render
+    pool process (and keep its source when a source cache budget is given),
+    then record its metrics and source copy here.
+    """
+    key = render_settings_key(settings)
+    os.makedirs(os.path.join(cache_dir, key), exist_ok=True)
+    keep_source = source_budget and not asset_id.startswith(LOCAL_ASSET_PREFIX)
+    source_bytes, metrics = pool.submit(
+        render_to_cache, image_data, original_path,
+        cached_frame_path(key, asset_id), cached_frame_path(key, asset_id, 'original'), settings,
+        source_cache_path(asset_id) if keep_source else None
+    ).result()
+    
+    for name, value in metrics:
+        record_metric(name, value)
+    if source_bytes is not None:
+        register_source(asset_id, original_path, source_bytes, source_budget)
+
+def save_cached_frame(asset_id, key):
+    """
+    Store the pre-rendered frame of an asset as a new (unpublished) frame
+    (hard links, no re-encoding). Returns (frame_id, processed image), None
+    if not cached.
+    """
+    if not os.path.exists(cached_frame_path(key, asset_id)):
+        return None
+    
+    with timed_stage('frame-cache'):
+        try:
+            with new_generation() as (frame_id, directory):
+                for variant in ('original', 'frame'):
+                    try:
+                        os.link(cached_frame_path(key, asset_id, variant), generation_file(directory, variant))
+                    except OSError:
+                        shutil.copyfile(cached_frame_path(key, asset_id, variant), generation_file(directory, variant))
+                with Image.open(generation_file(directory)) as frame:
+                    processed = frame.convert('RGB')
+        except OSError as e:
+            logger.warning(f"Cached frame of {asset_id} unusable, rendering instead: {e}")
+            return None
+        logger.info(f"Saved frame {frame_id} from frame cache")
+    
+    return frame_id, processed
+
+# =============== PRE-RENDER JOB ===============
+# Renders the whole album (or the next N photos in play order) into the frame
+# cache ahead of time. POST /api/prerender queues a job in prerender.json with
+# its items in epf.db. A watcher thread started with the background services
+# (in one gunicorn worker) runs it under an exclusive lock: a few threads
+# download from Immich and a process pool sized to the host renders. Finished
+# items are recorded one by one, so a job resumes where it stopped after a
+# restart.
+prerender_state_file = os.path.join(photo_dir, 'prerender.json')
+prerender_lock_file = os.path.join(photo_dir, 'prerender.lock')
+PRERENDER_WORKERS = int(os.getenv('PRERENDER_WORKERS', '0')) or max(1, min((os.cpu_count() or 2) - 1, 4))
+PRERENDER_DOWNLOADS = int(os.getenv('PRERENDER_DOWNLOADS', '2'))
+PRERENDER_POLL_INTERVAL = 2
+PRERENDER_MAX_POOL_RESTARTS = 3
+PRERENDER_ACTIVE = ('queued', 'running', 'cancelling')
+
+def create_prerender_job(count=None):
+    """
+    Queue a pre-render job for the configured album with the current
+    settings. Returns the job, or None if one is already active.
+    """
+    album_id, revision = current_album()
+    album = local_folder if photo_source == 'folder' else album_name
+    mode = image_order if image_order in DECK_MODES else 'random'
+    items = deck_play_order(album_id, mode, revision, count)
+    settings = render_settings()
+    job = {
+        'job_id': new_frame_id(),
+        'status': 'queued',
+        'album': album,
+        'album_id': album_id,
+        'count': count,
+        'total': len(items),
+        'settings': settings,
+        'settings_key': render_settings_key(settings),
+        'created_at': time.time(),
+    }
+    
+    with db_transaction() as conn:
+        # Checked inside the transaction so two requests can't both start a job
+        if read_json_file(prerender_state_file, {}).get('status') in PRERENDER_ACTIVE:
+            return None
+        conn.execute('DELETE FROM prerender_items')
+        conn.executemany(
+            'INSERT INTO prerender_items (job_id, position, asset_id, original_path) VALUES (?, ?, ?, ?)',
+            [(job['job_id'], position, asset_id, original_path)
+             for position, (asset_id, original_path) in enumerate(items)]
+        )
+        write_json_file(prerender_state_file, job)
+    
+    remove_stale_cache(job['settings_key'])
+    logger.info(f"Pre-render job {job['job_id']} queued: {len(items)} photos of album {album}")
+    return job
+
+def update_prerender_job(**changes):
+    """Change fields of the current job's state file; returns the new state"""
+    job = read_json_file(prerender_state_file, {})
+    job.update(changes)
+    write_json_file(prerender_state_file, job)
+    return job
+
+def finish_prerender_item(job_id, position, state, error=None):
+    get_db().execute(
+        'UPDATE prerender_items SET state = ?, error = ?, finished_at = ? WHERE job_id = ? AND position = ?',
+        (state, error, time.time(), job_id, position)
+    )
+
+def run_prerender_job(job):
+    """Render the pending items of a job; returns when it is done or cancelled"""
+    job_id, key = job['job_id'], job['settings_key']
+    now = time.time()
+    job = update_prerender_job(status='running', started_at=job.get('started_at') or now,
+                               run_started_at=now, owner_pid=os.getpid(), error=None)
+    
+    for attempt in range(PRERENDER_MAX_POOL_RESTARTS + 1):
+        items = get_db().execute(
+            "SELECT position, asset_id, original_path FROM prerender_items "
+            "WHERE job_id = ? AND state = 'pending' ORDER BY position",
+            (job_id,)
+        ).fetchall()
+        if not items:
+            break
+        logger.info(f"Pre-render job {job_id}: {len(items)} of {job['total']} photos left, "
+                    f"{PRERENDER_WORKERS} render processes")
         
-        os.chmod(tracking_file, 0o666)
+        download_slots = threading.Semaphore(PRERENDER_DOWNLOADS)
+        pool_broken = threading.Event()
         
-        with open(tracking_file, 'r') as f:  # ← FIX: 'with open'
-            lines = f.readlines()
+        def process(item):
+            position, asset_id, original_path = item
+            if pool_broken.is_set() or background_stop.is_set() or read_json_file(prerender_state_file, {}).get('status') != 'running':
+                return
+            if os.path.exists(cached_frame_path(key, asset_id)):
+                finish_prerender_item(job_id, position, 'cached')
+                return
+            try:
+                source = read_source_data(asset_id)
+                if source is not None:
+                    render_into_cache(pool, asset_id, source, source_cache_path(asset_id), job['settings'])
+                else:
+                    with download_slots:
+                        image_data = fetch_original(asset_id, original_path)
+                    render_into_cache(pool, asset_id, image_data, original_path, job['settings'],
+                                      source_cache_budget())
+                finish_prerender_item(job_id, position, 'done')
+            except BrokenProcessPool:
+                pool_broken.set()  # Item stays pending for the next pool
+            except Exception as e:
+                logger.warning(f"Pre-render of {asset_id} failed: {e}")
+                finish_prerender_item(job_id, position, 'failed', str(e))
         
-        if not lines or lines[0].strip() != album_name:
-            with open(tracking_file, 'w') as f:  # ← FIX: Neue 'with open'
-                f.write(f"{album_name}\n")
-            return set()
+        with render_pool(PRERENDER_WORKERS) as pool:
+            with ThreadPoolExecutor(PRERENDER_WORKERS + PRERENDER_DOWNLOADS, thread_name_prefix='prerender') as feeders:
+                for _ in feeders.map(process, items):
+                    pass
         
-        return {line.strip() for line in lines[1:] if line.strip()}
+        if background_stop.is_set():
+            logger.info(f"Pre-render job {job_id} interrupted, resuming on next start")
+            return
+        if not pool_broken.is_set():
+            break
+        logger.warning(f"Pre-render process pool died (out of memory?), restart {attempt + 1}")
+    else:
+        update_prerender_job(status='failed', finished_at=time.time(),
+                             error='Render processes kept dying (out of memory?)')
+        return
     
-    except Exception as e:
-        logger.error(f"Error reading tracking file: {e}")
-        return set()
+    job = read_json_file(prerender_state_file, {})
+    status = 'cancelled' if job.get('status') == 'cancelling' else 'done'
+    update_prerender_job(status=status, finished_at=time.time())
+    logger.info(f"Pre-render job {job_id} {status}")
 
-def save_downloaded_image(asset_id):
-    """Save downloaded image ID to tracking.txt"""
-    global album_name
-    try:
-        if not os.path.exists(tracking_file):
-            with open(tracking_file, 'w') as f:
-                pass
-        
-        os.chmod(tracking_file, 0o666)
-        
-        with open(tracking_file, 'r') as f:  # ← FIX: 'with open'
-            lines = f.readlines()
-        
-        if not lines or lines[0].strip() != album_name:
-            with open(tracking_file, 'w') as f:  # ← FIX: Neue 'with open'
-                f.write(f"{album_name}\n")
+def run_prerender_watcher():
+    """Pick up queued or interrupted pre-render jobs; only the holder of prerender.lock runs one"""
+    while not background_stop.is_set():
+        try:
+            if read_json_file(prerender_state_file, {}).get('status') in PRERENDER_ACTIVE:
+                with open(prerender_lock_file, 'w') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        pass  # Another process is running it
+                    else:
+                        job = read_json_file(prerender_state_file, {})
+                        if job.get('status') == 'cancelling':
+                            update_prerender_job(status='cancelled', finished_at=time.time())
+                        elif job.get('status') in PRERENDER_ACTIVE:
+                            run_prerender_job(job)
+        except Exception as e:
+            logger.error(f"Pre-render job failed: {e}", exc_info=True)
+            try:
+                update_prerender_job(status='failed', finished_at=time.time(), error=str(e))
+            except Exception as state_error:
+                logger.error(f"Could not mark the pre-render job as failed: {state_error}")
         
-        with open(tracking_file, 'a') as f:  # ← FIX: Append mode
-            f.write(f"{asset_id}\n")
-    
-    except Exception as e:
-        logger.error(f"Error writing to tracking file: {e}")
+        background_stop.wait(PRERENDER_POLL_INTERVAL)
 
-def reset_tracking_file():
-    """Reset tracking.txt file"""
-    try:
-        open(tracking_file, 'w').close()
-    except Exception as e:
-        logger.error(f"Error resetting tracking file: {e}")
+def prerender_status():
+    """Progress, throughput and ETA of the current (or last) pre-render job"""
+    job = read_json_file(prerender_state_file)
+    if not job:
+        return {'status': 'idle'}
+    
+    counts = dict(get_db().execute(
+        'SELECT state, COUNT(*) FROM prerender_items WHERE job_id = ? GROUP BY state',
+        (job['job_id'],)
+    ).fetchall())
+    
+    # Throughput of the current run (renders only, cache hits are free)
+    run_started_at = job.get('run_started_at')
+    frames_per_minute = None
+    if run_started_at:
+        rendered = get_db().execute(
+            "SELECT COUNT(*), MAX(finished_at) FROM prerender_items "
+            "WHERE job_id = ? AND state IN ('done', 'failed') AND finished_at >= ?",
+            (job['job_id'], run_started_at)
+        ).fetchone()
+        elapsed = (job.get('finished_at') or time.time()) - run_started_at
+        if rendered[0] and elapsed > 0:
+            frames_per_minute = round(rendered[0] / elapsed * 60, 1)
+    
+    pending = counts.get('pending', 0)
+    total = job.get('total', 0)
+    eta_seconds = None
+    if job['status'] == 'running' and frames_per_minute:
+        eta_seconds = int(pending / frames_per_minute * 60)
+    
+    return {
+        'status': job['status'],
+        'job_id': job['job_id'],
+        'album': job.get('album'),
+        'total': total,
+        'done': counts.get('done', 0),
+        'cached': counts.get('cached', 0),
+        'failed': counts.get('failed', 0),
+        'pending': pending,
+        'progress': round((total - pending) / total, 3) if total else 1.0,
+        'frames_per_minute': frames_per_minute,
+        'eta_seconds': eta_seconds,
+        'workers': PRERENDER_WORKERS,
+        'settings_current': job.get('settings_key') == render_settings_key(render_settings()),
+        'created_at': job.get('created_at'),
+        'finished_at': job.get('finished_at'),
+        'error': job.get('error'),
+    }
+
+# =============== DEVICE SCHEDULE ===============
+# Every frame gets a fixed offset (hash of its device id) within
+# wakeup_window after each wakeup_interval boundary, so a fleet of frames
+# doesn't wake at the same second. /sleep stores the resulting wakeup per
+# device, and the render scheduler (background service in one gunicorn
+# worker) renders the photo each device will get into the frame cache
+# RENDER_LEAD_TIME before it is due, one device after the other, in one
+# render process that is kept between renders.
+MIN_SLEEP = timedelta(minutes=10)
+RENDER_LEAD_TIME = int(os.getenv('RENDER_LEAD_TIME', '300'))
+RENDER_SCHEDULER_INTERVAL = 30
+DEVICE_OVERDUE_GRACE = 120  # A device this late is considered gone until it calls /sleep again
+scheduler_pool = None  # Render process of the scheduler, see scheduler_render_pool()
+
+def device_id():
+    """Id of the calling frame: ?device=, X-Device-Id header, else its IP address"""
+    return request.args.get('device') or request.headers.get('X-Device-Id') or request.remote_addr or 'unknown'
+
+def record_device(device, **fields):
+    """Insert or update a device row (last_seen is always refreshed)"""
+    now = time.time()
+    columns = ['last_seen', *fields]
+    get_db().execute(
+        f"""INSERT INTO devices (device_id, first_seen, {', '.join(columns)})
+            VALUES (?, ?, {', '.join('?' * len(columns))})
+            ON CONFLICT(device_id) DO UPDATE SET
+            {', '.join(f'{column} = excluded.{column}' for column in columns)}""",
+        (device, now, now, *fields.values())
+    )
 
-# =============== NEW: DEPALETTE AND HEX CONVERSION ===============
-def depalette_image(pixels, palette):
+def wakeup_offset(device, window_minutes):
+    """Deterministic per-device offset in seconds within the wakeup window"""
+    window = max(int(window_minutes) * 60, 0)
+    if window == 0:
+        return 0
+    digest = hashlib.sha256(device.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % window
+
+def quiet_hours_end(moment):
+    """End of the sleep_start..sleep_end quiet period containing moment, None outside of it"""
+    start = current_config['immich']['sleep_start_hour'] * 60 + current_config['immich']['sleep_start_minute']
+    end = current_config['immich']['sleep_end_hour'] * 60 + current_config['immich']['sleep_end_minute']
+    minute = moment.hour * 60 + moment.minute
+    
+    if start == end:
+        return None
+    if start < end:
+        quiet = start <= minute < end
+    else:
+        quiet = minute >= start or minute < end
+    if not quiet:
+        return None
+    
+    end_time = moment.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0)
+    return end_time if end_time > moment else end_time + timedelta(days=1)
+
+def next_device_wakeup(now, offset):
     """
-    Convert RGB image to palette indices using nearest color matching.
-    This is the Python equivalent of the Cython depalette_image function.
+    Next wakeup of a device: the next wakeup_interval boundary (counted from
+    midnight) plus its offset, at least MIN_SLEEP away; a wakeup in the quiet
+    hours moves to their end plus the offset.
     """
-    palette_array = np.array(palette)
-    
-    # Calculate color distances
-    diffs = np.sqrt(np.sum((pixels[:, :, None, :] - palette_array[None, None, :, :]) ** 2, axis=3))
-    
-    # Find closest palette color for each pixel
-    indices = np.argmin(diffs, axis=2)
-    
-    # Simulate special case from C code (index 3 becomes 1)
-    indices[indices > 3] += 1
-    
-    return indices
+    interval = int(current_config['immich']['wakeup_interval'])
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    boundary = (now.hour * 60 + now.minute) // interval * interval
+    
+    # Bounded: at most two days of boundaries
+    for _ in range(2 * (24 * 60 // interval + 1)):
+        candidate = day + timedelta(minutes=boundary, seconds=offset)
+        quiet_end = quiet_hours_end(candidate)
+        if quiet_end:
+            candidate = quiet_end + timedelta(seconds=offset)
+        if candidate - now >= MIN_SLEEP:
+            return candidate
+        
+        boundary += interval
+        if boundary >= 24 * 60:
+            day += timedelta(days=1)
+            boundary = 0
+    return now + timedelta(minutes=interval)
+
+def upcoming_devices(now):
+    """(device_id, next_wakeup) of devices that are still expected, soonest first"""
+    return get_db().execute(
+        'SELECT device_id, next_wakeup FROM devices WHERE next_wakeup > ? ORDER BY next_wakeup',
+        (now - DEVICE_OVERDUE_GRACE,)
+    ).fetchall()
 
-def convert_to_hex_format(image_data):
+def scheduler_render_pool():
+    """The scheduler's render process, started on first use and kept between renders"""
+    global scheduler_pool
+    if scheduler_pool is None:
+        scheduler_pool = render_pool(1)
+    return scheduler_pool
+
+def close_scheduler_pool(wait=True):
+    global scheduler_pool
+    if scheduler_pool is not None:
+        scheduler_pool.shutdown(wait=wait, cancel_futures=True)
+        scheduler_pool = None
+
+def schedule_renders():
     """
-    Convert processed image data to hex-encoded format expected by ESP32.
-    Two pixels are packed into one byte (4-bit per pixel).
-    Returns comma-separated hex values as text.
+    One scheduler pass: render the photos of devices due within
+    RENDER_LEAD_TIME into the frame cache. The n-th upcoming device will
+    draw the n-th asset of the deck (the first one takes a prepared photo
+    if there is one).
     """
-    # Get pixel data as numpy array
-    pixels = np.array(image_data)
-    
-    # Convert to palette indices
-    indices = depalette_image(pixels, palette)
-    
-    height, width = indices.shape
+    now = time.time()
+    devices = upcoming_devices(now)
+    due = [position for position, (_, wakeup) in enumerate(devices) if wakeup - RENDER_LEAD_TIME <= now]
+    if not due or (photo_source != 'folder' and immich_unreachable()):
+        return
+    if read_json_file(prerender_state_file, {}).get('status') in PRERENDER_ACTIVE:
+        return  # The pre-render job is filling the cache already
     
-    # Pack two 4-bit indices into one byte
-    bytes_array = []
-    for y in range(height):
-        for x in range(0, width, 2):
-            if x + 1 < width:
-                # Pack two pixels: left pixel in high nibble, right pixel in low nibble
-                byte_value = (indices[y, x] << 4) | indices[y, x + 1]
-            else:
-                # Last pixel in row (if width is odd)
-                byte_value = indices[y, x] << 4
-            
-            bytes_array.append(byte_value)
-    
-    # Convert to hex string with comma separators (ESP32 format)
-    output = io.StringIO()
-    for i, byte_value in enumerate(bytes_array):
-        output.write(f"{byte_value:02X}")
-        if (i + 1) % 16 == 0:  # Line break every 16 bytes for readability
-            output.write(",\n")
+    skip = 1 if read_frame_state().get('status') == 'new' else 0
+    try:
+        album_id, revision = current_album()
+    except PhotoFetchError:
+        return  # Not configured (or the folder is still being indexed)
+    mode = image_order if image_order in DECK_MODES else 'random'
+    items = deck_play_order(album_id, mode, revision, due[-1] + 1)
+    settings = render_settings()
+    key = render_settings_key(settings)
+    
+    for position in due:
+        if position < skip or position - skip >= len(items):
+            continue
+        asset_id, original_path = items[position - skip]
+        if os.path.exists(cached_frame_path(key, asset_id)):
+            continue
+        
+        started = time.perf_counter()
+        source = read_source_data(asset_id)
+        if source is not None:
+            args = (asset_id, source, source_cache_path(asset_id), settings)
         else:
-            output.write(",")
+            args = (asset_id, fetch_original(asset_id, original_path), original_path, settings, source_cache_budget())
+        # The render process keeps the full-size decode out of this process
+        render_into_cache(scheduler_render_pool(), *args)
+        record_metric('scheduled_render_ms', (time.perf_counter() - started) * 1000)
+        logger.info(f"Scheduled render of {asset_id} for device {devices[position][0]}")
+        return  # One render per pass spreads the work out
+
+def run_render_scheduler():
+    """Render photos for devices shortly before they wake up"""
+    while not background_stop.is_set():
+        try:
+            if config_handler is not None:
+                config_handler.reload_if_changed()
+            schedule_renders()
+        except BrokenProcessPool:
+            logger.warning("Scheduled render process died (out of memory?)")
+            close_scheduler_pool(wait=False)
+        except Exception as e:
+            logger.error(f"Render scheduler error: {e}", exc_info=True)
+        
+        background_stop.wait(RENDER_SCHEDULER_INTERVAL)
+    
+    close_scheduler_pool()
+
+# =============== EVENT STREAM ===============
+# /api/events pushes battery, preview status and pre-render progress to the
+# settings page (Server-Sent Events) instead of every tab polling. Each
+# stream watches the state files by mtime, which works across gunicorn
+# workers, and only reads them when they changed.
+EVENT_POLL_INTERVAL = 1
+EVENT_KEEPALIVE_INTERVAL = 15
+EVENT_STREAM_MAX_AGE = 300  # Then the browser reconnects, so threads are recycled
+
+def battery_status_data():
+    """Battery state as shown on the settings page"""
+    battery_voltage, battery_updated_at = read_battery()
+    current_time = time.time()
     
-    # Remove trailing comma
-    result = output.getvalue().rstrip(',\n')
+    # Only report a recent value (< ~1d)
+    if current_time - battery_updated_at >= 90000:
+        battery_voltage = 0
     
-    # Return as BytesIO for Flask send_file
-    output_bytes = io.BytesIO(result.encode('utf-8'))
-    output_bytes.seek(0)
+    battery_percentage = calculate_battery_percentage(battery_voltage) if battery_voltage > 0 else 0
     
-    return output_bytes
+    return {
+        'voltage': int(battery_voltage),  # in mV
+        'voltage_v': round(battery_voltage / 1000, 2),  # in V
+        'percentage': battery_percentage,
+        'last_update': int(battery_updated_at),
+        'age_seconds': int(current_time - battery_updated_at) if battery_updated_at > 0 else None
+    }
 
-# =============== IMAGE PROCESSING ===============
-def scale_img_in_memory(image, target_width=800, target_height=480, bg_color=(255, 255, 255)):
-    """
-    Process image in memory using Cython.
-    Supports both Atkinson and Floyd-Steinberg dithering.
-    """
-    global rotation_angle, dithering_method
-    rotation = rotation_angle
+def preview_status_data():
+    """Which frame is prepared and which was delivered"""
+    state = read_frame_state()
+    frame_id = state.get('latest')
     
-    # Extract EXIF date
     try:
-        exif = image.getexif()
-        datetime_str = exif.get(36867) if exif else None
-        if not datetime_str and exif:
-            datetime_str = exif.get(306)
-    except:
-        datetime_str = None
-    
-    # Auto-rotate based on EXIF
-    image = ImageOps.exif_transpose(image)
-    
-    # Check Cython availability
-    if not CYTHON_AVAILABLE:
-        logger.error("Cython not available - image processing will fail!")
-        raise RuntimeError("Cython module 'cpy' is required but not available")
-    
-    logger.info(f"Using Cython load_scaled(rotation={rotation}, mode={display_mode})")
-    img = load_scaled(image, rotation, display_mode)
-    logger.info(f"Image after load_scaled: size={img.size}, mode={img.mode}")
-    
-    # Enhancement
-    enhanced_img = ImageEnhance.Color(img).enhance(img_enhanced)
-    enhanced_img = ImageEnhance.Contrast(enhanced_img).enhance(img_contrast)
-    logger.info(f"Enhanced: color={img_enhanced}, contrast={img_contrast}")
-    
-    # Dithering
-    if dithering_method == 'floyd-steinberg' and FLOYD_AVAILABLE:
-        logger.info(f"Using Floyd-Steinberg dithering: strength={strength}")
-        output_img = convert_image_floyd(enhanced_img, strength)
-        output_img = Image.fromarray(output_img, mode='RGB')
-    elif dithering_method == 'atkinson' and ATKINSON_AVAILABLE:
-        logger.info(f"Using Atkinson dithering: strength={strength}")
-        output_img = convert_image_atkinson(enhanced_img, strength)
-        output_img = Image.fromarray(output_img, mode='RGB')
-    else:
-        # Fallback
-        if FLOYD_AVAILABLE:
-            logger.warning(f"{dithering_method} not available, using Floyd-Steinberg")
-            output_img = convert_image_floyd(enhanced_img, strength)
-            output_img = Image.fromarray(output_img, mode='RGB')
-        else:
-            raise RuntimeError("No dithering method available")
+        timestamp = os.path.getmtime(frame_path(frame_id)) if frame_id else None
+    except OSError:
+        timestamp = None
+    if timestamp is None:
+        return {'exists': False, 'status': None, 'timestamp': None}
     
-    logger.info(f"Image after dithering: size={output_img.size}, mode={output_img.mode}")
-    
-    # Add date overlay
-    if datetime_str:
-        draw = ImageDraw.Draw(output_img)
-        try:
-            font = ImageFont.truetype('/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 20)
-        except:
-            font = ImageFont.load_default()
-        
+    return {
+        'exists': True,
+        'status': state.get('status') or 'delivered',
+        'frame_id': frame_id,
+        'delivered_frame_id': state.get('delivered'),
+        'timestamp': timestamp,
+        'formatted_time': datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+def file_version(*paths):
+    """Cheap change marker for state files (mtime and inode, None if missing)"""
+    versions = []
+    for path in paths:
         try:
-            try:
-                dt = datetime.strptime(datetime_str, '%Y:%m:%d %H:%M:%S')
-                formatted_time = dt.strftime('%Y-%m-%d')
-            except ValueError:
-                dt = datetime.strptime(datetime_str, '%Y.%m.%d')
-                formatted_time = dt.strftime('%Y-%m-%d')
-        except:
-            formatted_time = datetime_str
-        
-        text_bbox = draw.textbbox((0, 0), formatted_time, font=font)
-        text_width = text_bbox[2] - text_bbox[0]
-        text_height = text_bbox[3] - text_bbox[1]
-        padding = 5
+            stat = os.stat(path)
+            versions.append((stat.st_mtime_ns, stat.st_ino))
+        except OSError:
+            versions.append(None)
+    return tuple(versions)
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+# Event name -> (watched files, payload); a payload is sent on connect and
+# whenever one of its files changes
+EVENT_SOURCES = {
+    'battery': ((battery_state_file,), battery_status_data),
+    'status': ((frame_state_file,), preview_status_data),
+    'prerender': ((prerender_state_file,), prerender_status),
+}
+
+def iter_events(max_age=EVENT_STREAM_MAX_AGE):
+    """Server-Sent Events for one settings page, ends after max_age seconds"""
+    started = last_sent = time.monotonic()
+    versions = {}
+    last_prerender = None
+    
+    yield f"retry: {EVENT_POLL_INTERVAL * 3000}\n\n"
+    while time.monotonic() - started < max_age:
+        for name, (paths, payload) in EVENT_SOURCES.items():
+            version = file_version(*paths)
+            if versions.get(name) == version:
+                continue
+            versions[name] = version
+            data = payload()
+            if name == 'prerender':
+                last_prerender = data
+            yield format_event(name, data)
+            last_sent = time.monotonic()
         
-        position = (target_width - text_width - 40, target_height - text_height - 40)
-        rect_coords = (
-            position[0] - padding,
-            position[1] - padding,
-            position[0] + text_width + padding,
-            position[1] + text_height + padding
-        )
+        # Item progress of a running job is in epf.db, not in its state file
+        if last_prerender and last_prerender['status'] in PRERENDER_ACTIVE:
+            data = prerender_status()
+            if data['pending'] != last_prerender['pending']:
+                last_prerender = data
+                yield format_event('prerender', data)
+                last_sent = time.monotonic()
         
-        draw.rectangle(rect_coords, fill=(0, 0, 0))
-        draw.text(position, formatted_time, fill=(255, 255, 255), font=font)
-        logger.info(f"Date overlay: {formatted_time}")
-    
-    # Save preview as JPEG
-    preview_jpg_path = os.path.join(photo_dir, 'latest_preview.jpg')
-    output_img.save(preview_jpg_path, 'JPEG', quality=85)
-    logger.info(f"Preview saved")
-    
-    return output_img
-
-def save_three_previews(image_original):
-    """
-    Save three preview versions:
-    1. latest_original.jpg - Original (unprocessed, only resized)
-    2. latest_processed.jpg - Processed (rotated + dithered, ready for ESP32)
-    3. latest.bmp - BMP for ESP32 download
-    """
-    # 1. Save original unprocessed (only resize to fit display)
-    original_path = os.path.join(photo_dir, 'latest_original.jpg')
-    image_resized = image_original.copy()
-    image_resized.thumbnail((800, 480), Image.LANCZOS)
-    image_resized.save(original_path, 'JPEG', quality=95)
-    logger.info(f"Saved original preview: {original_path}")
-    
-    # 2. Process with rotation + dithering for ESP32
-    processed_rotated = scale_img_in_memory(image_original)
-    processed_path = os.path.join(photo_dir, 'latest_processed.jpg')
-    processed_rotated.save(processed_path, 'JPEG', quality=95)
-    logger.info(f"Saved processed preview (rotated + dithered): {processed_path}")
-    
-    # 3. Save as BMP for ESP32 download
-    bmp_path = os.path.join(photo_dir, 'latest.bmp')
-    bmp_io = io.BytesIO()
-    processed_rotated.save(bmp_io, 'BMP')
-    with open(bmp_path, 'wb') as f:
-        f.write(bmp_io.getvalue())
-    logger.info(f"Saved BMP for ESP32: {bmp_path}")
-    
-    return processed_rotated
-
-# =============== RAW/HEIC CONVERTERS ===============
-def convert_raw_or_dng_to_jpg(input_file_path, output_dir):
-    """Convert RAW/DNG to JPG"""
-    with rawpy.imread(input_file_path) as raw:
-        rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
-    
-    basename = os.path.splitext(os.path.basename(input_file_path))[0]
-    jpg_path = os.path.join(output_dir, f'{basename}.jpg')
-    Image.fromarray(rgb).save(jpg_path, 'JPEG')
-    return jpg_path
-
-def convert_heic_to_jpg(input_file_path, output_dir):
-    """Convert HEIC to JPG"""
-    img = Image.open(input_file_path).convert('RGB')
-    basename = os.path.splitext(os.path.basename(input_file_path))[0]
-    jpg_path = os.path.join(output_dir, f'{basename}.jpg')
-    img.save(jpg_path, 'JPEG', quality=95)
-    return jpg_path
+        if time.monotonic() - last_sent >= EVENT_KEEPALIVE_INTERVAL:
+            yield ': keepalive\n\n'
+            last_sent = time.monotonic()
+        time.sleep(EVENT_POLL_INTERVAL)
 
 # =============== CONFIGURATION WATCHER ===============
-class ConfigFileHandler(FileSystemEventHandler):
-    """Watch config.yaml for changes"""
+class ConfigFileHandler:
+    """
+    Load config.yaml and reload it when it changes.
+    Every worker checks the file's mtime before a request (one stat call),
+    so no watcher thread is needed per worker.
+    """
     def __init__(self, config_path, config_update_callback):
         self.config_path = config_path
         self.config_update_callback = config_update_callback
+        self.mtime_ns = None
         self.ensure_config_exists()
         self.config = self.load_config()
     
@@ -457,14 +2173,20 @@ class ConfigFileHandler(FileSystemEventHandler):
             except Exception as e:
                 logger.error(f"Error creating config: {e}")
     
-    def on_modified(self, event):
-        if event.src_path == self.config_path:
+    def reload_if_changed(self):
+        try:
+            mtime_ns = os.stat(self.config_path).st_mtime_ns
+        except OSError:
+            return
+        
+        if mtime_ns != self.mtime_ns:
             logger.info("Config modified, reloading...")
-            new_config = self.load_config()
-            self.config_update_callback(new_config)
+            self.config = self.load_config()
+            self.config_update_callback(self.config)
     
     def load_config(self):
         try:
+            self.mtime_ns = os.stat(self.config_path).st_mtime_ns
             with open(self.config_path, 'r') as f:
                 config = yaml.safe_load(f)
                 # ← FIX: Rückfall auf Default-Config
@@ -480,6 +2202,8 @@ def update_app_config(new_config):
     """Update configuration"""
     global current_config, url, album_name, rotation_angle, img_enhanced, img_contrast
     global strength, display_mode, image_order, dithering_method, sleep_start_hour, sleep_end_hour, sleep_start_minute, sleep_end_minute
+    global debug_profiling, raw_strategy, shuffle_seed, date_position, date_size, date_format, dithering_space
+    global photo_source, local_folder
     
     # ← FIX: Validierung hinzufügen!
     if new_config is None or 'immich' not in new_config:
@@ -496,50 +2220,155 @@ def update_app_config(new_config):
     display_mode = new_config['immich']['display_mode']
     image_order = new_config['immich']['image_order']
     dithering_method = new_config['immich'].get('dithering_method', 'atkinson')
+    dithering_space = new_config['immich'].get('dithering_space', DEFAULT_CONFIG['immich']['dithering_space'])
+    photo_source = new_config['immich'].get('photo_source', DEFAULT_CONFIG['immich']['photo_source'])
+    local_folder = new_config['immich'].get('local_folder', DEFAULT_CONFIG['immich']['local_folder'])
     sleep_start_hour = new_config['immich']['sleep_start_hour']
     sleep_end_hour = new_config['immich']['sleep_end_hour']
     sleep_start_minute = new_config['immich']['sleep_start_minute']
     sleep_end_minute = new_config['immich']['sleep_end_minute']
+    debug_profiling = bool(new_config['immich'].get('debug_profiling', DEFAULT_CONFIG['immich']['debug_profiling']))
+    raw_strategy = new_config['immich'].get('raw_strategy', DEFAULT_CONFIG['immich']['raw_strategy'])
+    shuffle_seed = str(new_config['immich'].get('shuffle_seed', DEFAULT_CONFIG['immich']['shuffle_seed']) or '')
+    date_position = new_config['immich'].get('date_position', DEFAULT_CONFIG['immich']['date_position'])
+    date_size = int(new_config['immich'].get('date_size', DEFAULT_CONFIG['immich']['date_size']))
+    date_format = new_config['immich'].get('date_format', DEFAULT_CONFIG['immich']['date_format']) or DEFAULT_CONFIG['immich']['date_format']
     
     logger.info(f"Config updated: URL={url}, Album={album_name}, Rotation={rotation_angle}, Dithering={dithering_method}")
 
-def start_config_watcher(config_path):
-    """Start watching config.yaml"""
-    config_handler = ConfigFileHandler(config_path, update_app_config)
-    observer = Observer()
-    observer.schedule(config_handler, path=os.path.dirname(config_path), recursive=False)
-    observer.start()
-    return observer
+# =============== IMMICH HEALTH PROBER ===============
+# /health answers from this cached state instead of calling Immich itself,
+# so a slow or unreachable Immich never blocks a request thread.
+health_state_file = os.path.join(photo_dir, 'immich_health.json')
+HEALTH_PROBE_INTERVAL = int(os.getenv('HEALTH_PROBE_INTERVAL', '30'))
+HEALTH_PROBE_MAX_INTERVAL = int(os.getenv('HEALTH_PROBE_MAX_INTERVAL', '300'))
+
+def probe_immich():
+    """Ping Immich once and return (reachable, latency_ms, error)"""
+    start = time.perf_counter()
+    try:
+        response = requests.get(f"{url}/api/server/ping", timeout=5)
+        latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        if response.status_code == 200:
+            return True, latency_ms, None
+        return False, latency_ms, f"HTTP {response.status_code}"
+    except requests.exceptions.RequestException as e:
+        return False, None, type(e).__name__
 
-# =============== FLASK APP ===============
-app = Flask(__name__)
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+def run_immich_health_prober():
+    """Refresh Immich reachability in the background, backing off while it is down"""
+    failures = 0
+    while True:
+        if photo_source == 'folder':
+            time.sleep(HEALTH_PROBE_INTERVAL)  # Idle while Immich is not the photo source
+            continue
+        
+        try:
+            reachable, latency_ms, error = probe_immich()
+            failures = 0 if reachable else failures + 1
+            write_json_file(health_state_file, {
+                'reachable': reachable,
+                'latency_ms': latency_ms,
+                'error': error,
+                'consecutive_failures': failures,
+                'checked_at': time.time(),
+            })
+            if not reachable:
+                logger.warning(f"Immich unreachable ({error}), {failures} failed probe(s)")
+        except Exception as e:
+            logger.error(f"Health probe failed: {e}")
+        
+        time.sleep(min(HEALTH_PROBE_INTERVAL * 2 ** min(failures, 8), HEALTH_PROBE_MAX_INTERVAL))
 
-logger.info("=" * 80)
-logger.info("EPF Flask Server ( + HA) - Initializing")
-logger.info(f"Build Version: {BUILD_VERSION} - {BUILD_TIMESTAMP}")
-logger.info("=" * 80)
-logger.info(f"Cython Available: {CYTHON_AVAILABLE}")
-logger.info(f"Config Path: {config_path}")
-logger.info("=" * 80)
+def get_frame_health():
+    """Summary of the stored frames for /health"""
+    state = read_frame_state()
+    frame_id = state.get('latest')
+    frame_bmp = frame_path(frame_id) if frame_id else None
+    
+    frame_count = 0
+    cache_bytes = 0
+    try:
+        for entry in os.scandir(frames_dir):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            frame_count += 1
+            for file_entry in os.scandir(entry.path):
+                cache_bytes += file_entry.stat().st_size
+    except OSError:
+        pass
+    
+    if not frame_bmp or not os.path.exists(frame_bmp):
+        return {'latest': None, 'pending_delivery': False, 'frames': frame_count, 'cache_bytes': cache_bytes}
+    
+    return {
+        'latest': frame_id,
+        'age_seconds': int(time.time() - os.path.getmtime(frame_bmp)),
+        'pending_delivery': state.get('status') == 'new',
+        'delivered': state.get('delivered'),
+        'frames': frame_count,
+        'cache_bytes': cache_bytes,
+    }
 
+# =============== FLASK BLUEPRINT ===============
 bp = Blueprint('main', __name__)
+config_handler = None
+
+@bp.before_request
+def begin_request_timing():
+    """Reload a changed config, start the total timer and, if requested, the profiler"""
+    if config_handler is not None:
+        config_handler.reload_if_changed()
+    
+    g.request_start = time.perf_counter()
+    g.profiler = start_request_profile() if profiling_requested() else None
+
+@bp.after_request
+def add_server_timing(response):
+    """Attach stage durations of pipeline requests as Server-Timing header"""
+    timings = g.get('stage_timings')
+    if timings:
+        total_ms = (time.perf_counter() - g.request_start) * 1000
+        response.headers['Server-Timing'] = format_server_timing(timings, total_ms)
+    
+    # Profile until the server closed the response: the hex frame of
+    # /download is encoded while it is streamed, after this hook. Files
+    # (send_file) are passed to the server as they are and never run close
+    # callbacks, but their body is complete already.
+    profiler = g.get('profiler')
+    if profiler is not None:
+        g.profiler = None
+        title = f"{request.method} {request.path}"
+        timings = list(g.get('stage_timings', []))
+        started = g.request_start
+        finish = lambda: finish_request_profile(profiler, title, timings, started)
+        if response.direct_passthrough:
+            finish()
+        else:
+            response.call_on_close(finish)
+    return response
+
+@bp.teardown_request
+def release_request_profile(exc):
+    """Make sure a profiler is released if the request failed before after_request"""
+    if g.get('profiler') is not None:
+        finish_request_profile(g.profiler, f"{request.method} {request.path}",
+                               g.get('stage_timings', []), g.request_start)
+        g.profiler = None
 
 # =============== ROUTES ===============
 @bp.route('/', methods=['GET', 'POST'])
 def settings():
     """Settings page - ROOT ROUTE"""
-    global current_config, last_battery_voltage, last_battery_update
+    global current_config
     
     # ← FIX: Fallback auf DEFAULT_CONFIG
     if current_config is None:
         current_config = DEFAULT_CONFIG.copy()
         logger.warning("current_config was None, reset to default")
     
-    current_time = time.time()
-    if current_time - last_battery_update < 3600:
-        battery_voltage = last_battery_voltage
-    else:
+    battery_voltage, battery_updated_at = read_battery()
+    if time.time() - battery_updated_at >= 3600:
         battery_voltage = 0
     
     battery_percentage = calculate_battery_percentage(battery_voltage) if battery_voltage > 0 else 0
@@ -559,16 +2388,29 @@ def settings():
                 'display_mode': request.form.get('display_mode', current_config['immich']['display_mode']),
                 'image_order': request.form.get('image_order', current_config['immich']['image_order']),
                 'dithering_method': request.form.get('dithering_method', current_config['immich'].get('dithering_method', 'atkinson')),
+                'dithering_space': request.form.get('dithering_space', current_config['immich'].get('dithering_space', DEFAULT_CONFIG['immich']['dithering_space'])),
                 'sleep_start_hour': int(request.form.get('sleep_start_hour', current_config['immich']['sleep_start_hour'])),
                 'sleep_start_minute': int(request.form.get('sleep_start_minute', current_config['immich']['sleep_start_minute'])),
                 'sleep_end_hour': int(request.form.get('sleep_end_hour', current_config['immich']['sleep_end_hour'])),
                 'sleep_end_minute': int(request.form.get('sleep_end_minute', current_config['immich']['sleep_end_minute'])),
                 'wakeup_interval': int(request.form.get('wakeup_interval', current_config['immich']['wakeup_interval'])),
+                'wakeup_window': int(request.form.get('wakeup_window', current_config['immich'].get('wakeup_window', DEFAULT_CONFIG['immich']['wakeup_window']))),
+                'source_cache_size': int(request.form.get('source_cache_size', current_config['immich'].get('source_cache_size', DEFAULT_CONFIG['immich']['source_cache_size']))),
+                'photo_source': request.form.get('photo_source', current_config['immich'].get('photo_source', DEFAULT_CONFIG['immich']['photo_source'])),
+                'local_folder': request.form.get('local_folder', current_config['immich'].get('local_folder', DEFAULT_CONFIG['immich']['local_folder'])),
+                'debug_profiling': current_config['immich'].get('debug_profiling', DEFAULT_CONFIG['immich']['debug_profiling']),
+                'raw_strategy': request.form.get('raw_strategy', current_config['immich'].get('raw_strategy', DEFAULT_CONFIG['immich']['raw_strategy'])),
+                'shuffle_seed': request.form.get('shuffle_seed', current_config['immich'].get('shuffle_seed', DEFAULT_CONFIG['immich']['shuffle_seed'])).strip(),
+                'date_position': request.form.get('date_position', current_config['immich'].get('date_position', DEFAULT_CONFIG['immich']['date_position'])),
+                'date_size': int(request.form.get('date_size', current_config['immich'].get('date_size', DEFAULT_CONFIG['immich']['date_size']))),
+                'date_format': request.form.get('date_format', current_config['immich'].get('date_format', DEFAULT_CONFIG['immich']['date_format'])).strip() or DEFAULT_CONFIG['immich']['date_format'],
             }
         }
         
         if new_config['immich']['rotation'] not in [0, 90, 180, 270]:
             return "Invalid rotation", 400
+        if new_config['immich']['date_position'] not in DATE_POSITIONS:
+            return "Invalid date position", 400
         
         try:
             with open(config_path, 'w') as f:
@@ -589,19 +2431,39 @@ def settings():
 
 @bp.route('/health', methods=['GET', 'HEAD'])
 def health():
-    """Health check endpoint"""
-    try:
-        response = requests.get(f"{url}/api/server/ping", timeout=5)
-        immich_ok = response.status_code == 200
-    except:
-        immich_ok = False
+    """Health check endpoint (answers from the background prober's cached state)"""
+    state = read_json_file(health_state_file)
     
-    status_code = 200 if immich_ok else 503
-    return jsonify({
-        'status': 'healthy' if immich_ok else 'degraded',
+    if state is None:
+        immich = {'state': 'unknown', 'age_seconds': None}
+    else:
+        age = time.time() - state['checked_at']
+        if age > 2 * HEALTH_PROBE_MAX_INTERVAL:
+            immich_state = 'stale'
+        else:
+            immich_state = 'connected' if state['reachable'] else 'unreachable'
+        immich = {
+            'state': immich_state,
+            'latency_ms': state['latency_ms'],
+            'error': state['error'],
+            'consecutive_failures': state['consecutive_failures'],
+            'age_seconds': round(age, 1),
+        }
+    
+    result = {
         'timestamp': datetime.now().isoformat(),
-        'immich': 'connected' if immich_ok else 'unreachable'
-    }), status_code
+        'immich': immich['state'],
+        'immich_probe': immich,
+        'frames': get_frame_health(),
+        'source_cache': get_source_cache_stats()
+    }
+    if photo_source == 'folder':
+        result['folder'] = get_folder_stats()
+        source_ok = result['folder']['available']
+    else:
+        source_ok = immich['state'] == 'connected'
+    result['status'] = 'healthy' if source_ok else 'degraded'
+    return jsonify(result), 200 if source_ok else 503
 
 @bp.route('/download', methods=['GET'])
 def process_and_download():
@@ -609,168 +2471,44 @@ def process_and_download():
     Download and process image from Immich.
     CHANGED: Now returns hex-encoded format instead of BMP!
     """
-    global url, album_name, last_battery_voltage, last_battery_update
-    
     # Battery tracking
     try:
         battery_voltage = float(request.headers.get('batteryCap', 0))
         if battery_voltage > 0:
-            last_battery_voltage = battery_voltage
-            last_battery_update = time.time()
+            record_battery(battery_voltage)
     except:
-        pass
-    
-    # Check for pre-prepared photo
-    preview_bmp_path = os.path.join(photo_dir, 'latest.bmp')
-    status_file = os.path.join(photo_dir, 'latest.status')
+        battery_voltage = 0
+    record_device(device_id(), **({'battery': battery_voltage} if battery_voltage > 0 else {}))
     
-    if os.path.exists(preview_bmp_path) and os.path.exists(status_file):
-        try:
-            with open(status_file, 'r') as f:
-                status = f.read().strip()
-            
-            if status == 'new':
-                logger.info("Serving pre-prepared photo to ESP32")
-                
-                # CHANGED: Convert BMP to hex format before sending
-                bmp_image = Image.open(preview_bmp_path)
-                hex_data = convert_to_hex_format(bmp_image)
-                
-                # ✅ NEU: Copy processed.jpg to delivered.jpg
-                from shutil import copy2
-                processed_path = os.path.join(photo_dir, 'latest_processed.jpg')
-                delivered_path = os.path.join(photo_dir, 'latest_delivered.jpg')
-                if os.path.exists(processed_path):
-                    copy2(processed_path, delivered_path)
-                    logger.info("✅ Copied processed → delivered")
-                
-                with open(status_file, 'w') as f:
-                    f.write('delivered')
-                
-                return send_file(
-                    hex_data,
-                    mimetype='text/plain',
-                    as_attachment=True,
-                    download_name='frame.txt'
-                )
+    # Check for pre-prepared photo (claimed atomically, so only one device gets it)
+    try:
+        frame_id = claim_pending_frame()
+        if frame_id:
+            logger.info("Serving pre-prepared photo to ESP32")
             
-        except Exception as e:
-            logger.warning(f"Error reading status: {e}")
+            # CHANGED: Convert BMP to the ESP32 frame format before sending
+            with Image.open(frame_path(frame_id)) as bmp_image:
+                return send_frame(bmp_image)
+    
+    except Exception as e:
+        logger.warning(f"Error serving prepared photo: {e}")
     
     # Fetch and prepare photo on-the-fly
     logger.info("Fetching and preparing photo on-the-fly")
     
     try:
-        if not url or not album_name:
-            return jsonify({'error': 'Not configured'}), 500
-        
-        # Fetch album
-        response = requests.get(f'{url}/api/albums', headers=headers, timeout=10)
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to fetch albums'}), 500
-        
-        data = response.json()
-        album_id = next((item['id'] for item in data if item.get('albumName') == album_name), None)
-        
-        if not album_id:
-            return jsonify({'error': f'Album {album_name} not found'}), 404
-        
-        # Fetch album assets
-        response = requests.get(f'{url}/api/albums/{album_id}', headers=headers, timeout=10)
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to fetch album assets'}), 500
-        
-        data = response.json()
-        if 'assets' not in data or not data['assets']:
-            return jsonify({'error': 'No images in album'}), 404
-        
-        # Select image
-        image_order_config = current_config['immich'].get('image_order', 'random')
-        downloaded_images = load_downloaded_images()
-        
-        if image_order_config == 'newest':
-            # Sortiere absteigend nach Datum (neueste zuerst)
-            sorted_assets = sorted(data['assets'],
-                key=lambda x: x.get('exifInfo', {}).get('dateTimeOriginal', '1970-01-01T00:00:00'),
-                reverse=True)
-            
-            # ← FIX: Verwende auch Tracking im "newest" Modus!
-            downloaded_images = load_downloaded_images()
-            remaining_images = [img for img in sorted_assets if img['id'] not in downloaded_images]
-            
-            if not remaining_images:
-                reset_tracking_file()
-                remaining_images = sorted_assets
-            
-            # Nimm das erste noch nicht gezeigte Bild aus der sortierten Liste
-            selected_image = remaining_images[0]
-
-        else:  # random
-            remaining_images = [img for img in data['assets'] if img['id'] not in downloaded_images]
-            if not remaining_images:
-                reset_tracking_file()
-                remaining_images = data['assets']
-            
-            # ← Verwende random.choice für echte Zufallsauswahl
-            selected_image = random.choice(remaining_images)
+        # ✅ Render (or take from the frame cache) and store the frame, mark it as delivered right away
+        asset_id, frame_id, processed = prepare_next_frame()
+        publish_frame(frame_id, delivered=True)
 
-        asset_id = selected_image['id']
-        save_downloaded_image(asset_id)  # Markiere als gesehen
-        
-        # Download image
-        response = requests.get(
-            f'{url}/api/assets/{asset_id}/original',
-            headers=headers,
-            stream=True,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to download image'}), 500
-        
-        image_data = io.BytesIO(response.content)
-        original_path = selected_image.get('originalPath', '').lower()
-        
-        # Process based on file type
-        if original_path.endswith(('.raw', '.dng', '.arw', '.cr2', '.nef')):
-            with rawpy.imread(image_data) as raw:
-                rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
-            image = Image.fromarray(rgb)
-        elif original_path.endswith('.heic'):
-            image = Image.open(image_data).convert('RGB')
-        else:
-            image = Image.open(image_data)
-        
-        # ✅ Save all three preview versions
-        save_three_previews(image)
-
-        # ✅ Copy processed to delivered immediately
-        from shutil import copy2
-        processed_path = os.path.join(photo_dir, 'latest_processed.jpg')
-        delivered_path = os.path.join(photo_dir, 'latest_delivered.jpg')
-        if os.path.exists(processed_path):
-            copy2(processed_path, delivered_path)
-            logger.info("✅ Copied processed → delivered (on-the-fly)")
-
-        # ✅ Mark as delivered
-        status_file = os.path.join(photo_dir, 'latest.status')
-        with open(status_file, 'w') as f:
-            f.write('delivered')
-
-        # ✅ Convert to hex and return
-        preview_bmp_path = os.path.join(photo_dir, 'latest.bmp')
-        bmp_image = Image.open(preview_bmp_path)
-        hex_data = convert_to_hex_format(bmp_image)
-
-        logger.info(f"Photo delivered on-the-fly (hex format): {asset_id}")
-
-        return send_file(
-            hex_data,
-            mimetype='text/plain',
-            as_attachment=True,
-            download_name='frame.txt'
-        )
-    
+        # ✅ Encode and return
+        response = send_frame(processed)
+        logger.info(f"Photo delivered on-the-fly: {asset_id}")
+        return response
+    
+    except PhotoFetchError as e:
+        logger.error(f"Error fetching photo: {e}")
+        return jsonify({'error': str(e)}), e.status_code
     except requests.exceptions.RequestException as e:
         logger.error(f"Network error: {e}")
         return jsonify({'error': f'Network error: {str(e)}'}), 500
@@ -782,183 +2520,55 @@ def process_and_download():
 def preview_photo():
     """Serve the latest prepared photo as preview (backwards compatibility)"""
     # Try processed first, fall back to original
-    processed_path = os.path.join(photo_dir, 'latest_processed.jpg')
-    original_path = os.path.join(photo_dir, 'latest_original.jpg')
-    
-    if os.path.exists(processed_path):
-        return send_file(processed_path, mimetype='image/jpeg')
-    elif os.path.exists(original_path):
-        return send_file(original_path, mimetype='image/jpeg')
-    else:
-        return jsonify({'error': 'No preview available'}), 404
+    frame_id = read_frame_state().get('latest')
+    if get_preview_path(frame_id, 'processed'):
+        return send_preview(frame_id, 'processed', 'No preview available')
+    return send_preview(frame_id, 'original', 'No preview available')
 
 @bp.route('/preview-status', methods=['GET'])
 def preview_status():
     """Get the status of the current preview photo"""
-    status_file = os.path.join(photo_dir, 'latest.status')
-    processed_path = os.path.join(photo_dir, 'latest_processed.jpg')  # ✅ RICHTIG!
-    
-    if not os.path.exists(processed_path):
-        return jsonify({'exists': False, 'status': None, 'timestamp': None})
-    
-    status = 'delivered'
-    if os.path.exists(status_file):
-        with open(status_file, 'r') as f:
-            status = f.read().strip()
-    
-    timestamp = os.path.getmtime(processed_path)
-    
-    return jsonify({
-        'exists': True,
-        'status': status,
-        'timestamp': timestamp,
-        'formatted_time': datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-    })
+    data = preview_status_data()
+    if not data['exists']:
+        return jsonify(data)
+    
+    response = jsonify(data)
+    response.set_etag(f"{data['frame_id']}-{data['delivered_frame_id']}-{data['status']}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @bp.route('/preview-original', methods=['GET'])
 def preview_original():
     """Serve original unprocessed image"""
-    original_path = os.path.join(photo_dir, 'latest_original.jpg')
-    if not os.path.exists(original_path):
-        return jsonify({'error': 'No original available'}), 404
-    return send_file(original_path, mimetype='image/jpeg')
+    return send_preview(read_frame_state().get('latest'), 'original', 'No original available')
 
 @bp.route('/preview-processed', methods=['GET'])
 def preview_processed():
     """Serve processed image (ready for ESP32 with rotation + dithering)"""
-    processed_path = os.path.join(photo_dir, 'latest_processed.jpg')
-    if not os.path.exists(processed_path):
-        return jsonify({'error': 'No processed image available'}), 404
-    return send_file(processed_path, mimetype='image/jpeg')
+    return send_preview(read_frame_state().get('latest'), 'processed', 'No processed image available')
 
 @bp.route('/preview-delivered', methods=['GET'])
 def preview_delivered():
     """Serve last delivered image to ESP32"""
-    delivered_path = os.path.join(photo_dir, 'latest_delivered.jpg')
-    if not os.path.exists(delivered_path):
-        return jsonify({'error': 'No delivered image available'}), 404
-    return send_file(delivered_path, mimetype='image/jpeg')
+    return send_preview(read_frame_state().get('delivered'), 'processed', 'No delivered image available')
 
 @bp.route('/api/battery-status', methods=['GET'])
 def battery_status():
     """Get current battery status for JavaScript polling"""
-    global last_battery_voltage, last_battery_update
-    
-    current_time = time.time()
-    
-    # Return cached value if recent (< ~1d)
-    if current_time - last_battery_update < 90000:
-        battery_voltage = last_battery_voltage
-    else:
-        battery_voltage = 0
-    
-    battery_percentage = calculate_battery_percentage(battery_voltage) if battery_voltage > 0 else 0
-    
-    return jsonify({
-        'voltage': int(battery_voltage),  # in mV
-        'voltage_v': round(battery_voltage / 1000, 2),  # in V
-        'percentage': battery_percentage,
-        'last_update': int(last_battery_update),
-        'age_seconds': int(current_time - last_battery_update) if last_battery_update > 0 else None
-    })
+    return jsonify(battery_status_data())
 
 @bp.route('/prepare-photo', methods=['POST'])
 def prepare_photo():
     """Manually fetch and prepare a new photo from Immich"""
     try:
         logger.info("📸 Manual photo preparation requested")
-        immich_url = current_config['immich']['url']
-        album_name = current_config['immich']['album']
-        image_order_config = current_config['immich']['image_order']
-        
-        if not immich_url or not album_name:
-            return jsonify({'error': 'Immich not configured', 'success': False}), 500
-        
-        api_key = os.getenv('IMMICH_API_KEY')
-        if not api_key:
-            return jsonify({'error': 'IMMICH_API_KEY not configured', 'success': False}), 500
-        
-        headers = {'x-api-key': api_key}
-        
-        # Get albums
-        response = requests.get(f'{immich_url}/api/albums', headers=headers)
-        if response.status_code != 200:
-            return jsonify({'error': f'Failed to fetch albums: {response.status_code}', 'success': False}), 500
-        
-        albums = response.json()
-        target_album = next((a for a in albums if a['albumName'] == album_name), None)
-        
-        if not target_album:
-            return jsonify({'error': f'Album "{album_name}" not found', 'success': False}), 404
-        
-        album_id = target_album['id']
+        # ✅ Render (or take from the frame cache) and store the frame
+        asset_id, frame_id, _ = prepare_next_frame()
         
-        # Get album assets
-        response = requests.get(f'{immich_url}/api/albums/{album_id}', headers=headers)
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to fetch album assets', 'success': False}), 500
-        
-        data = response.json()
-        
-        if not data.get('assets') or len(data['assets']) == 0:
-            return jsonify({'error': 'No assets in album', 'success': False}), 404
-        
-        # Image selection based on order
-        downloaded_images = load_downloaded_images()
-        
-        if image_order_config == 'newest':
-            sorted_assets = sorted(data['assets'],
-                key=lambda x: x.get('exifInfo', {}).get('dateTimeOriginal', '1970-01-01T00:00:00'),
-                reverse=True)
-            remaining_images = [img for img in sorted_assets if img['id'] not in downloaded_images]
-            
-            if not remaining_images:
-                reset_tracking_file()
-                remaining_images = sorted_assets
-            
-            selected_image = remaining_images[0]
-        else:  # random
-            remaining_images = [img for img in data['assets'] if img['id'] not in downloaded_images]
-            if not remaining_images:
-                reset_tracking_file()
-                remaining_images = data['assets']
-            selected_image = random.choice(remaining_images)
-        
-        asset_id = selected_image['id']
-        save_downloaded_image(asset_id)
-        
-        # Download image
-        response = requests.get(
-            f'{immich_url}/api/assets/{asset_id}/original',
-            headers=headers,
-            stream=True
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': 'Failed to download image', 'success': False}), 500
-        
-        image_data = io.BytesIO(response.content)
-        original_path = selected_image.get('originalPath', '').lower()
-        
-        # Process based on file type
-        if original_path.endswith(('.raw', '.dng', '.arw', '.cr2', '.nef')):
-            with rawpy.imread(image_data) as raw:
-                rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
-                image = Image.fromarray(rgb)
-        elif original_path.endswith('.heic'):
-            image = Image.open(image_data).convert('RGB')
-        else:
-            image = Image.open(image_data)
-        
-        # ✅ Save all three preview versions
-        save_three_previews(image)
+        # Publish as 'new' (waiting for the next /download)
+        publish_frame(frame_id)
         
-        # Save status as 'new'
-        status_file = os.path.join(photo_dir, 'latest.status')
-        with open(status_file, 'w') as f:
-            f.write('new')
-        
-        logger.info(f"✅ Photo prepared with 3 previews: {asset_id}")
+        logger.info(f"✅ Photo prepared as frame {frame_id}: {asset_id}")
         
         return jsonify({
             'success': True,
@@ -966,84 +2576,107 @@ def prepare_photo():
             'asset_id': asset_id
         }), 200
     
+    except PhotoFetchError as e:
+        logger.error(f"❌ Error fetching photo: {e}")
+        return jsonify({'error': str(e), 'success': False}), e.status_code
     except Exception as e:
         logger.error(f"❌ Error preparing photo: {e}", exc_info=True)
         return jsonify({'error': str(e), 'success': False}), 500
 
+@bp.route('/api/prerender', methods=['GET'])
+def prerender_job_status():
+    """Progress of the current or last pre-render job"""
+    return jsonify(prerender_status())
+
+@bp.route('/api/prerender', methods=['POST'])
+def start_prerender():
+    """Pre-render the album (or the next `count` photos in play order) into the frame cache"""
+    payload = request.get_json(silent=True) or request.form
+    count = payload.get('count') or None
+    try:
+        count = int(count) if count is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'count must be a number'}), 400
+    if count is not None and count < 1:
+        return jsonify({'error': 'count must be at least 1'}), 400
+    
+    try:
+        job = create_prerender_job(count)
+    except PhotoFetchError as e:
+        logger.error(f"Error starting pre-render: {e}")
+        return jsonify({'error': str(e)}), e.status_code
+    
+    if job is None:
+        return jsonify({'error': 'A pre-render job is already running', **prerender_status()}), 409
+    return jsonify(prerender_status()), 202
+
+@bp.route('/api/prerender/cancel', methods=['POST'])
+def cancel_prerender():
+    """Stop the running pre-render job after the photos in progress"""
+    if read_json_file(prerender_state_file, {}).get('status') in ('queued', 'running'):
+        update_prerender_job(status='cancelling')
+    return jsonify(prerender_status())
+
+@bp.route('/api/events', methods=['GET'])
+def events():
+    """Server-Sent Events stream with battery, preview status and pre-render progress"""
+    response = Response(iter_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let a proxy buffer the stream
+    return response
+
+@bp.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Counters and timings shared by all workers"""
+    return jsonify(get_metrics())
+
+@bp.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """Latest per-request profile (only reachable through HA ingress)"""
+    if not is_ingress_request():
+        return jsonify({'error': 'Debug endpoints are only available via Home Assistant ingress'}), 403
+    
+    profile_path = os.path.join(profile_dir, 'profile_latest.txt')
+    if not os.path.exists(profile_path):
+        return jsonify({'error': f'No profile captured yet (send {PROFILE_HEADER}: 1 or enable debug_profiling)'}), 404
+    return send_file(profile_path, mimetype='text/plain', max_age=0)
+
+@bp.route('/debug/startup', methods=['GET'])
+def debug_startup():
+    """Import/startup timings of this worker (only reachable through HA ingress)"""
+    if not is_ingress_request():
+        return jsonify({'error': 'Debug endpoints are only available via Home Assistant ingress'}), 403
+    return jsonify(dict(STARTUP_REPORT, worker_pid=os.getpid()))
+
 @bp.route('/sleep', methods=['GET'])
 def get_sleep_duration():
-    """Get sleep duration for ESP32"""
+    """Get sleep duration for ESP32 (its own slot after the next interval boundary)"""
     current_time = datetime.now()
-    interval = int(current_config['immich']['wakeup_interval'])
-    
-    def calculate_next_interval_time(base_time, intervals=1):
-        total_minutes = base_time.hour * 60 + base_time.minute
-        next_total_minutes = ((total_minutes // interval) + intervals) * interval
-        next_total_minutes %= (24 * 60)
-        
-        next_time = base_time.replace(
-            hour=next_total_minutes // 60,
-            minute=next_total_minutes % 60,
-            second=0,
-            microsecond=0
-        )
-        
-        if next_time <= base_time:
-            next_time = next_time + timedelta(days=1)
-        
-        return next_time
-    
-    next_wakeup = calculate_next_interval_time(current_time)
-    
-    sleep_start = current_time.replace(
-        hour=current_config['immich']['sleep_start_hour'],
-        minute=current_config['immich']['sleep_start_minute'],
-        second=0,
-        microsecond=0
-    )
-    
-    sleep_end = current_time.replace(
-        hour=current_config['immich']['sleep_end_hour'],
-        minute=current_config['immich']['sleep_end_minute'],
-        second=0,
-        microsecond=0
-    )
-    
-    if sleep_end <= sleep_start:
-        if current_time >= sleep_start or current_time <= sleep_end:
-            sleep_end = sleep_end + timedelta(days=1)
-        elif current_time <= sleep_end:
-            sleep_start = sleep_start - timedelta(days=1)
-    
-    if sleep_start <= next_wakeup <= sleep_end:
-        next_wakeup = sleep_end
-    
+    device = device_id()
+    offset = wakeup_offset(device, current_config['immich'].get('wakeup_window', DEFAULT_CONFIG['immich']['wakeup_window']))
+    next_wakeup = next_device_wakeup(current_time, offset)
     sleep_ms = int((next_wakeup - current_time).total_seconds() * 1000)
     
-    if sleep_ms <= 600000:
-        next_wakeup = calculate_next_interval_time(current_time, intervals=2)
-        if sleep_start <= next_wakeup <= sleep_end:
-            next_wakeup = sleep_end
-        sleep_ms = int((next_wakeup - current_time).total_seconds() * 1000)
+    record_device(device, next_wakeup=next_wakeup.timestamp(), wakeup_offset=offset)
     
     return jsonify({
         'sleep_duration': sleep_ms,
         'current_time': current_time.strftime('%Y-%m-%d %H:%M:%S'),
-        'next_wakeup': next_wakeup.strftime('%Y-%m-%d %H:%M:%S')
+        'next_wakeup': next_wakeup.strftime('%Y-%m-%d %H:%M:%S'),
+        'device': device,
+        'wakeup_offset': offset
     })
 
-# Register blueprint
-app.register_blueprint(bp)
-logger.info("Blueprint registered")
-
-# =============== STARTUP ===============
-try:
-    initial_config = ConfigFileHandler(config_path, update_app_config).config
-    update_app_config(initial_config)
-except Exception as e:
-    logger.error(f"Failed to load initial config: {e}")
-
-config_observer = start_config_watcher(config_path)
+@bp.route('/api/devices', methods=['GET'])
+def list_devices():
+    """Known frames with their last contact, battery and next expected wakeup"""
+    rows = get_db().execute(
+        'SELECT device_id, first_seen, last_seen, next_wakeup, wakeup_offset, battery FROM devices ORDER BY next_wakeup'
+    ).fetchall()
+    return jsonify([
+        dict(zip(('device', 'first_seen', 'last_seen', 'next_wakeup', 'wakeup_offset', 'battery'), row))
+        for row in rows
+    ])
 
 def run_daily_ntp_sync():
     """Daily NTP sync"""
@@ -1059,6 +2692,7 @@ def run_daily_ntp_sync():
             time.sleep(wait_seconds)
             
             try:
+                import ntplib
                 ntp_client = ntplib.NTPClient()
                 response = ntp_client.request('pool.ntp.org', timeout=5)
                 logger.info(f"NTP sync at {datetime.fromtimestamp(response.tx_time)}")
@@ -1067,10 +2701,110 @@ def run_daily_ntp_sync():
         except:
             time.sleep(3600)
 
-# Start NTP sync thread
-ntp_thread = threading.Thread(target=run_daily_ntp_sync, daemon=True)
-ntp_thread.start()
+# =============== APP FACTORY & BACKGROUND SERVICES ===============
+background_services_lock = threading.Lock()
+background_services_started = False
+background_stop = threading.Event()  # Set on server shutdown
+services_lock_file = os.path.join(photo_dir, 'services.lock')
+services_lock = None
+SERVICES_LOCK_RETRY = 10  # Seconds between attempts of the workers that don't run the services
+
+def init_storage():
+    """Create the data directories (idempotent)"""
+    os.makedirs(photo_dir, exist_ok=True)
+    os.makedirs(frames_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.makedirs(source_dir, exist_ok=True)
+    
+    # Pointer files of the previous frame storage (frames.json replaces them)
+    for name in LEGACY_FRAME_FILES:
+        try:
+            os.remove(os.path.join(photo_dir, name))
+        except FileNotFoundError:
+            pass
+
+def create_app():
+    """
+    Build the Flask app: storage, initial config and routes.
+    Starts no threads; see start_background_services().
+    """
+    global config_handler
+    started = time.perf_counter()
+    
+    init_storage()
+    try:
+        config_handler = ConfigFileHandler(config_path, update_app_config)
+        update_app_config(config_handler.config)
+    except Exception as e:
+        logger.error(f"Failed to load initial config: {e}")
+    
+    flask_app = Flask(__name__)
+    flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
+    flask_app.register_blueprint(bp)
+    
+    logger.info("=" * 80)
+    logger.info("EPF Flask Server ( + HA) - Initializing")
+    logger.info(f"Build Version: {BUILD_VERSION} - {BUILD_TIMESTAMP}")
+    logger.info("=" * 80)
+    logger.info(f"Cython Available: {CYTHON_AVAILABLE}")
+    logger.info(f"Config Path: {config_path}")
+    logger.info("=" * 80)
+    
+    STARTUP_REPORT['create_app_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return flask_app
+
+def start_background_services():
+    """
+    Start NTP sync, the Immich health prober, the pre-render watcher, the
+    render scheduler and the photo folder watcher exactly once per server:
+    in the process that holds services.lock. Under gunicorn every worker
+    calls this (post_worker_init hook in gunicorn.conf.py) and the others
+    keep waiting for the lock, so the services move to another worker when
+    theirs exits. The master runs no threads, so workers are forked from a
+    single-threaded process.
+    """
+    global background_services_started
+    with background_services_lock:
+        if background_services_started:
+            return
+        background_services_started = True
+    
+    threading.Thread(target=run_background_services, daemon=True, name='services-owner').start()
+
+def run_background_services():
+    """Wait for services.lock, then start the background services in this process"""
+    global services_lock
+    lock = open(services_lock_file, 'a')
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if background_stop.wait(SERVICES_LOCK_RETRY):
+                lock.close()
+                return
+    services_lock = lock  # Held until this process exits
+    
+    threading.Thread(target=run_daily_ntp_sync, daemon=True, name='ntp-sync').start()
+    threading.Thread(target=run_immich_health_prober, daemon=True, name='immich-health').start()
+    threading.Thread(target=run_prerender_watcher, daemon=True, name='prerender').start()
+    threading.Thread(target=run_render_scheduler, daemon=True, name='render-scheduler').start()
+    threading.Thread(target=run_folder_watcher, daemon=True, name='folder-watcher').start()
+    logger.info(f"Background services started (pid {os.getpid()})")
+
+def stop_background_services():
+    """Let the pre-render job and the render scheduler stop after their current photos (worker shutdown)"""
+    background_stop.set()
+
+app = create_app()
+
+STARTUP_REPORT['total_ms'] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 1)
+logger.info(
+    f"Startup: imports={STARTUP_REPORT['imports_ms']}ms, cython={STARTUP_REPORT['cython_ms']}ms, "
+    f"create_app={STARTUP_REPORT['create_app_ms']}ms, total={STARTUP_REPORT['total_ms']}ms"
+)
 
 # =============== RUN APP ===============
 if __name__ == '__main__':
+    start_background_services()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -4,7 +4,7 @@
 import numpy as np
 cimport numpy as np
 cimport cython
-from libc.math cimport pow
+from libc.math cimport pow, fminf, fmaxf
 from PIL import Image
 from libc.stdint cimport uint16_t, uint32_t
 
@@ -45,49 +45,165 @@ cdef double gamma_linear(double inp) nogil:
         return pow((inp + 0.055) / (1.0 + 0.055), 2.4)
     return inp / 12.92
 
-def load_scaled(image, angle, display_mode='fit'):
-    if isinstance(image, str):
-        img = Image.open(image)
-    else:
-        img = image.copy()
-    
-    img = img.convert('RGB')
-    img = img.rotate(angle, expand=True)
+# sRGB -> linear light for every 8-bit value, so the linear-light kernel
+# never evaluates the transfer function per pixel
+SRGB_TO_LINEAR = np.array([gamma_linear(i / 255.0) for i in range(256)], dtype=np.float32)
+
+# Panel colours as written to the output by all dithering kernels
+EPD_COLORS = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 1.0], [1.0, 0.953, 0.220], [0.749, 0.0, 0.0], [0.392, 0.251, 1.0], [0.263, 0.541, 0.110]], dtype=np.float64)
+PANEL_COLORS = (EPD_COLORS * 255.0).astype(np.uint8)
+
+# Error diffusion taps (dx, dy, weight) of the linear-light kernel. The
+# weights sum to 1: the full error is diffused, so a flat patch keeps its
+# mean colour. Atkinson's usual 6/8 share would drop a quarter of every
+# error, and on the six-colour palette whole channels with it (a mid grey
+# came out as green and red dots), so its six taps get 1/6 each here.
+DIFFUSION_TAPS = {
+    'floyd-steinberg': ((1, 0, 7.0 / 16.0), (-1, 1, 3.0 / 16.0), (0, 1, 5.0 / 16.0), (1, 1, 1.0 / 16.0)),
+    'atkinson': ((1, 0, 1.0 / 6.0), (2, 0, 1.0 / 6.0), (-1, 1, 1.0 / 6.0), (0, 1, 1.0 / 6.0), (1, 1, 1.0 / 6.0), (0, 2, 1.0 / 6.0)),
+}
+
+# Lossless transposes for rotation angles (counter-clockwise, like Image.rotate)
+# and for EXIF orientations (as applied by ImageOps.exif_transpose)
+ROTATION_TRANSPOSES = {
+    0: (),
+    90: (Image.Transpose.ROTATE_90,),
+    180: (Image.Transpose.ROTATE_180,),
+    270: (Image.Transpose.ROTATE_270,),
+}
+ORIENTATION_TRANSPOSES = {
+    2: (Image.Transpose.FLIP_LEFT_RIGHT,),
+    3: (Image.Transpose.ROTATE_180,),
+    4: (Image.Transpose.FLIP_TOP_BOTTOM,),
+    5: (Image.Transpose.TRANSPOSE,),
+    6: (Image.Transpose.ROTATE_270,),
+    7: (Image.Transpose.TRANSVERSE,),
+    8: (Image.Transpose.ROTATE_90,),
+}
+SWAPPING_TRANSPOSES = (
+    Image.Transpose.ROTATE_90,
+    Image.Transpose.ROTATE_270,
+    Image.Transpose.TRANSPOSE,
+    Image.Transpose.TRANSVERSE,
+)
+# Box-filter prereduction down to REDUCING_GAP times the target size before
+# the LANCZOS pass (Image.thumbnail's default); visually identical to a plain
+# LANCZOS resize
+REDUCING_GAP = 2.0
+
+def transposed_size(size, transposes):
+    w, h = size
+    for op in transposes:
+        if op in SWAPPING_TRANSPOSES:
+            w, h = h, w
+    return w, h
+
+def untranspose_box(box, size, op):
+    """Map a box in the transposed image back to the image of the given size"""
+    x0, y0, x1, y1 = box
+    w, h = size
+    if op == Image.Transpose.FLIP_LEFT_RIGHT:
+        return (w - x1, y0, w - x0, y1)
+    if op == Image.Transpose.FLIP_TOP_BOTTOM:
+        return (x0, h - y1, x1, h - y0)
+    if op == Image.Transpose.ROTATE_90:
+        return (w - y1, x0, w - y0, x1)
+    if op == Image.Transpose.ROTATE_180:
+        return (w - x1, h - y1, w - x0, h - y0)
+    if op == Image.Transpose.ROTATE_270:
+        return (y0, h - x1, y1, h - x0)
+    if op == Image.Transpose.TRANSPOSE:
+        return (y0, x0, y1, x1)
+    return (w - y1, h - x1, w - y0, h - x0)  # TRANSVERSE
+
+def display_geometry(width, height, display_mode):
+    """
+    Scaled size of a width x height (display-oriented) image and the part of
+    it shown on the panel: (new_width, new_height, crop box). 'fill' crops
+    the centre, 'fit' shows everything.
+    """
+    orig_ratio = width / height
+    epd_ratio = EPD_W / EPD_H
     
     if display_mode == 'fill':
-        orig_ratio = img.width / img.height
-        epd_ratio = EPD_W / EPD_H
-        
         if orig_ratio > epd_ratio:
             new_height = EPD_H
             new_width = int(new_height * orig_ratio)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
             left = (new_width - EPD_W) // 2
-            img = img.crop((left, 0, left + EPD_W, EPD_H))
-        else:
-            new_width = EPD_W
-            new_height = int(new_width / orig_ratio)
-            img = img.resize((new_width, new_height), Image.LANCZOS)
-            top = (new_height - EPD_H) // 2
-            img = img.crop((0, top, EPD_W, top + EPD_H))
+            return new_width, new_height, (left, 0, left + EPD_W, EPD_H)
+        new_width = EPD_W
+        new_height = int(new_width / orig_ratio)
+        top = (new_height - EPD_H) // 2
+        return new_width, new_height, (0, top, EPD_W, top + EPD_H)
+    
+    if orig_ratio > epd_ratio:
+        new_width = EPD_W
+        new_height = int(new_width / orig_ratio)
     else:
-        orig_ratio = img.width / img.height
-        epd_ratio = EPD_W / EPD_H
-        
-        if orig_ratio > epd_ratio:
-            new_width = EPD_W
-            new_height = int(new_width / orig_ratio)
-        else:
-            new_height = EPD_H
-            new_width = int(new_height * orig_ratio)
-        
-        img = img.resize((new_width, new_height), Image.LANCZOS)
-        bg = Image.new('RGB', (EPD_W, EPD_H), (255, 255, 255))
-        offset = ((EPD_W - new_width) // 2, (EPD_H - new_height) // 2)
-        bg.paste(img, offset)
-        return bg
+        new_height = EPD_H
+        new_width = int(new_height * orig_ratio)
+    return new_width, new_height, (0, 0, new_width, new_height)
+
+def load_scaled(image, angle, display_mode='fit', orientation=1):
+    """
+    Scale (and rotate) an image for the panel. The crop/fit box is computed
+    in source coordinates and resized straight from the source; EXIF
+    orientation and rotations by multiples of 90 degrees are applied as
+    transposes of the small result.
+    """
+    if isinstance(image, str):
+        img = Image.open(image)
+    else:
+        img = image
+    
+    transposes = ORIENTATION_TRANSPOSES.get(orientation, ())
+    if angle % 360 in ROTATION_TRANSPOSES:
+        transposes += ROTATION_TRANSPOSES[angle % 360]
+    else:
+        # Arbitrary angle: rotate the full image as before
+        img = img.convert('RGB')
+        for op in transposes:
+            img = img.transpose(op)
+        img = img.rotate(angle, expand=True)
+        transposes = ()
+    
+    out_w, out_h = transposed_size(img.size, transposes)
+    new_width, new_height, crop = display_geometry(out_w, out_h, display_mode)
+    
+    if img.format == 'JPEG' and isinstance(image, str):
+        # Decode a JPEG at reduced DCT scale when it is much larger than needed
+        img.draft('RGB', transposed_size((new_width, new_height), transposes))
+        out_w, out_h = transposed_size(img.size, transposes)
+        new_width, new_height, crop = display_geometry(out_w, out_h, display_mode)
+    
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    
+    # Crop box in display orientation -> source coordinates
+    scale_x = out_w / new_width
+    scale_y = out_h / new_height
+    box = (crop[0] * scale_x, crop[1] * scale_y, crop[2] * scale_x, crop[3] * scale_y)
+    # (no negative indexing: this module is compiled with wraparound=False)
+    sizes = [img.size]
+    for op in transposes:
+        sizes.append(transposed_size(sizes[len(sizes) - 1], (op,)))
+    for i in reversed(range(len(transposes))):
+        box = untranspose_box(box, sizes[i], transposes[i])
+    box = (max(box[0], 0.0), max(box[1], 0.0), min(box[2], img.width), min(box[3], img.height))
+    
+    target = transposed_size((crop[2] - crop[0], crop[3] - crop[1]), transposes)
+    img = img.resize(target, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+    for op in transposes:
+        img = img.transpose(op)
+    img = img.convert('RGB')
+    
+    if display_mode == 'fill':
+        return img
     
-    return img
+    bg = Image.new('RGB', (EPD_W, EPD_H), (255, 255, 255))
+    offset = ((EPD_W - new_width) // 2, (EPD_H - new_height) // 2)
+    bg.paste(img, offset)
+    return bg
 
 def convert_image(input_image, preview_path=None, dithering_strength=1.0):
     cdef np.ndarray[np.uint8_t, ndim=3] img_array = np.array(input_image, dtype=np.uint8)
@@ -233,3 +349,75 @@ def convert_image_atkinson(input_image, preview_path=None, dithering_strength=1.
                 output_img[y, x, c] = <np.uint8_t>(epd_colors[best, c] * 255.0)
     
     return output_img
+
+cdef inline float clamp_unit(float value) nogil:
+    return fminf(fmaxf(value, 0.0), 1.0)
+
+def convert_image_linear(input_image, method='atkinson', dithering_strength=1.0):
+    """
+    Error diffusion in linear light: pixels and palette are linearized once
+    through SRGB_TO_LINEAR, the error is diffused as float without per-pixel
+    conversions. Same taps and output colours as convert_image (Floyd-
+    Steinberg) and convert_image_atkinson, but the full error is diffused
+    for both methods (see DIFFUSION_TAPS).
+    """
+    img = np.ascontiguousarray(np.asarray(input_image, dtype=np.uint8)[:, :, :3])
+    cdef float[:, :, ::1] work = SRGB_TO_LINEAR[img]
+    cdef float[:, ::1] linear_palette = SRGB_TO_LINEAR[PANEL_COLORS]
+    cdef np.uint8_t[:, ::1] panel_colors = PANEL_COLORS
+    output = np.zeros(img.shape, dtype=np.uint8)
+    cdef np.uint8_t[:, :, ::1] output_img = output
+    
+    taps = DIFFUSION_TAPS.get(method, DIFFUSION_TAPS['atkinson'])
+    cdef int tap_dx[8]
+    cdef int tap_dy[8]
+    cdef float tap_weight[8]
+    cdef int n_taps = len(taps)
+    cdef int t
+    for t, (dx, dy, weight) in enumerate(taps):
+        tap_dx[t] = dx
+        tap_dy[t] = dy
+        tap_weight[t] = weight
+    
+    cdef float strength = dithering_strength
+    cdef int height = work.shape[0]
+    cdef int width = work.shape[1]
+    cdef int n_colors = linear_palette.shape[0]
+    cdef int x, y, c, best, xx, yy
+    cdef float r, g, b, dr, dg, db, diff, min_diff, er, eg, eb, weight_t
+    
+    with nogil:
+        for y in range(height):
+            for x in range(width):
+                r = work[y, x, 0]
+                g = work[y, x, 1]
+                b = work[y, x, 2]
+                
+                min_diff = 1e30
+                best = 0
+                for c in range(n_colors):
+                    dr = r - linear_palette[c, 0]
+                    dg = g - linear_palette[c, 1]
+                    db = b - linear_palette[c, 2]
+                    diff = dr * dr + dg * dg + db * db
+                    if diff < min_diff:
+                        min_diff = diff
+                        best = c
+                
+                er = (r - linear_palette[best, 0]) * strength
+                eg = (g - linear_palette[best, 1]) * strength
+                eb = (b - linear_palette[best, 2]) * strength
+                for t in range(n_taps):
+                    xx = x + tap_dx[t]
+                    yy = y + tap_dy[t]
+                    if xx >= 0 and xx < width and yy < height:
+                        weight_t = tap_weight[t]
+                        work[yy, xx, 0] = clamp_unit(work[yy, xx, 0] + er * weight_t)
+                        work[yy, xx, 1] = clamp_unit(work[yy, xx, 1] + eg * weight_t)
+                        work[yy, xx, 2] = clamp_unit(work[yy, xx, 2] + eb * weight_t)
+                
+                output_img[y, x, 0] = panel_colors[best, 0]
+                output_img[y, x, 1] = panel_colors[best, 1]
+                output_img[y, x, 2] = panel_colors[best, 2]
+    
+    return output
@@ -0,0 +1,194 @@
+#-*- coding:utf8 -*-
+
+# ==============================================================================
+# ESP32 frame format: 6-colour palette, 4-bit packed frame buffer, hex text
+# and PackBits encodings. Only needs numpy (and the PIL image it is handed),
+# so it can be imported and tested without the Flask app.
+# ==============================================================================
+
+import numpy as np
+
+# =============== 6-COLOR PALETTE ===============
+palette = [
+    (0, 0, 0),         # Black
+    (255, 255, 255),   # White
+    (255, 243, 56),    # Yellow
+    (191, 0, 0),       # Red
+    (100, 64, 255),    # Blue
+    (67, 138, 28)      # Green
+]
+
+# =============== DEPALETTE AND HEX CONVERSION ===============
+def depalette_image(pixels, palette):
+    """
+    Convert RGB image to palette indices using nearest color matching.
+    This is the Python equivalent of the Cython depalette_image function.
+    """
+    palette_array = np.array(palette)
+    
+    # Calculate color distances
+    diffs = np.sqrt(np.sum((pixels[:, :, None, :] - palette_array[None, None, :, :]) ** 2, axis=3))
+    
+    # Find closest palette color for each pixel
+    indices = np.argmin(diffs, axis=2)
+    
+    # Simulate special case from C code (index 3 becomes 1)
+    indices[indices > 3] += 1
+    
+    return indices
+
+# Exact colours written by the Cython dithering kernels (EPD colours scaled
+# and truncated to 8 bit), in palette order
+DITHER_COLOURS = [
+    (0, 0, 0),
+    (255, 255, 255),
+    (255, 243, 56),
+    (190, 0, 0),
+    (99, 64, 255),
+    (67, 137, 28)
+]
+
+def colour_keys(pixels):
+    """Pack the RGB channels of a pixel array into one uint32 key per pixel"""
+    pixels = np.asarray(pixels, dtype=np.uint32)
+    return (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+# Sorted colour keys -> frame buffer index for every colour a processed frame
+# may contain, so packing a frame is a table lookup instead of a distance search
+_lut_colours = np.array(sorted(set(palette) | set(DITHER_COLOURS)), dtype=np.uint8)
+PALETTE_LUT_KEYS = colour_keys(_lut_colours)
+PALETTE_LUT_INDICES = depalette_image(_lut_colours[None], palette)[0].astype(np.uint8)
+
+FRAME_BAND_ROWS = 16  # Rows converted per step when packing/streaming a frame
+
+def frame_size(image_data):
+    """Number of bytes in the packed frame of an image"""
+    width, height = image_data.size
+    return (width + 1) // 2 * height
+
+def iter_packed_bands(image_data, band_rows=FRAME_BAND_ROWS):
+    """
+    Convert a processed image to the ESP32's 4-bit frame buffer layout,
+    FRAME_BAND_ROWS rows at a time. Two pixels are packed into one byte
+    (left pixel in the high nibble); an odd last pixel of a row leaves the
+    low nibble empty.
+    """
+    width, height = image_data.size
+    
+    for top in range(0, height, band_rows):
+        band = image_data.crop((0, top, width, min(top + band_rows, height))).convert('RGBX')
+        # Big-endian RGBX words shifted right by 8 are the colour keys
+        keys = np.frombuffer(band.tobytes(), dtype='>u4').reshape(band.height, width) >> 8
+        
+        # Processed frames are palette-exact: every pixel is in the table
+        slots = np.minimum(np.searchsorted(PALETTE_LUT_KEYS, keys), len(PALETTE_LUT_KEYS) - 1)
+        indices = PALETTE_LUT_INDICES[slots]
+        unmatched = PALETTE_LUT_KEYS[slots] != keys
+        if unmatched.any():
+            # Not a processed frame (e.g. a foreign image): nearest colour
+            pixels = np.stack([keys >> 16, (keys >> 8) & 0xFF, keys & 0xFF], axis=-1)
+            indices[unmatched] = depalette_image(pixels[unmatched][None], palette)[0]
+        
+        if width % 2:
+            indices = np.pad(indices, ((0, 0), (0, 1)))
+        yield ((indices[:, 0::2] << 4) | indices[:, 1::2]).tobytes()
+
+def pack_frame(image_data):
+    """Packed 4-bit frame buffer of a processed image, filled band by band"""
+    packed = bytearray(frame_size(image_data))
+    offset = 0
+    for band in iter_packed_bands(image_data):
+        packed[offset:offset + len(band)] = band
+        offset += len(band)
+    return packed
+
+def hex_frame_length(size):
+    """
+    Length of the hex text for a packed frame of the given size:
+    two digits per byte, a comma between bytes and a line break after
+    every 16 bytes except the last.
+    """
+    if size == 0:
+        return 0
+    return 2 * size + (size - 1) + (size - 1) // 16
+
+def iter_hex_frame(packed_bands):
+    """
+    Hex text format expected by the ESP32: comma-separated bytes,
+    line break after every 16 bytes, no trailing separator.
+    Encodes the packed bands as they arrive, in whole 16-byte lines.
+    """
+    pending = b''
+    first = True
+    for band in packed_bands:
+        pending += band
+        complete = len(pending) - len(pending) % 16
+        if not complete:
+            continue
+        lines = ',\n'.join(pending[i:i + 16].hex(',').upper() for i in range(0, complete, 16))
+        yield (lines if first else ',\n' + lines).encode('ascii')
+        pending = pending[complete:]
+        first = False
+    if pending:
+        line = pending.hex(',').upper()
+        yield (line if first else ',\n' + line).encode('ascii')
+
+def hex_encode_frame(packed):
+    """Hex text of a whole packed frame"""
+    return b''.join(iter_hex_frame([packed]))
+
+# =============== COMPRESSED FRAME ENCODING ===============
+# Optional PackBits run-length encoding of the packed frame, requested by the
+# ESP32 with the X-Frame-Encoding header. A control byte n is followed by
+#   n = 0..127:   n + 1 literal bytes
+#   n = 129..255: one byte repeated 257 - n times
+#   n = 128:      no-op
+# so the decoder only needs the current control byte and one data byte.
+
+def packbits_encode(packed):
+    """PackBits-encode the packed frame (runs of 3+ equal bytes become repeat packets)"""
+    data = np.frombuffer(packed, dtype=np.uint8)
+    if data.size == 0:
+        return b''
+    
+    # Runs of equal bytes: start offsets and lengths
+    run_starts = np.concatenate(([0], np.flatnonzero(data[1:] != data[:-1]) + 1))
+    run_lengths = np.diff(np.append(run_starts, data.size))
+    
+    output = bytearray()
+    
+    def write_literals(start, end):
+        for chunk_start in range(start, end, 128):
+            chunk = data[chunk_start:min(chunk_start + 128, end)]
+            output.append(len(chunk) - 1)
+            output.extend(chunk.tobytes())
+    
+    literal_start = 0
+    for run in np.flatnonzero(run_lengths >= 3):
+        start, length = int(run_starts[run]), int(run_lengths[run])
+        write_literals(literal_start, start)
+        value = int(data[start])
+        while length >= 2:
+            count = min(length, 128)
+            output.append(257 - count)
+            output.append(value)
+            length -= count
+        literal_start = start + int(run_lengths[run]) - length
+    write_literals(literal_start, data.size)
+    
+    return bytes(output)
+
+def packbits_decode(encoded):
+    """Reference decoder for packbits_encode (mirrors the ESP32 streaming decoder)"""
+    output = bytearray()
+    i = 0
+    while i < len(encoded):
+        control = encoded[i]
+        i += 1
+        if control < 128:
+            output.extend(encoded[i:i + control + 1])
+            i += control + 1
+        elif control > 128:
+            output.extend(encoded[i:i + 1] * (257 - control))
+            i += 1
+    return bytes(output)
@@ -0,0 +1,32 @@
+# ==============================================================================
+# Gunicorn configuration for the EPF add-on (used by run.sh)
+# ==============================================================================
+import os
+
+bind = '0.0.0.0:5000'
+workers = 2
+# Every open settings page holds one thread with its /api/events stream, so
+# leave enough threads for the ESP32 and API requests
+threads = 8
+timeout = 120
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'info')
+
+# Import app.py once in the master and fork the workers from it, so a worker
+# (re)start after an OOM kill does not pay the import cost again. The master
+# starts no threads or database connections; the background services run in
+# one of the workers.
+preload_app = True
+
+
+def post_worker_init(worker):
+    """Start the background services (NTP, Immich prober, renders) in one worker, see start_background_services()"""
+    import app
+    app.start_background_services()
+
+
+def worker_exit(server, worker):
+    """Stop the pre-render job and render scheduler instead of waiting for them"""
+    import app
+    app.stop_background_services()
@@ -0,0 +1,461 @@
+#-*- coding:utf8 -*-
+
+# ==============================================================================
+# Frame rendering: decoding (RAW/HEIC codecs on first use), scaling, colour
+# enhancement, dithering and the date overlay. Importing it only loads the
+# Cython module, so the render process pools run this instead of app.py.
+# Render settings are passed in (render_settings() in app.py); stage timings
+# and metrics are handed to the hooks set with set_hooks().
+# ==============================================================================
+
+import time
+import io
+import os
+import threading
+import logging
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageOps, ExifTags
+
+from framecodec import DITHER_COLOURS
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'  # As configured by app.py
+logger = logging.getLogger(__name__)
+
+# =============== CYTHON MODULE IMPORT ===============
+cython_import_started = time.perf_counter()
+try:
+    import cpy
+    logger.info(f"Cython functions: {[f for f in dir(cpy) if not f.startswith('_')]}")
+    
+    load_scaled = cpy.load_scaled
+    
+    if hasattr(cpy, 'convert_image'):
+        def convert_image_floyd(img, strength):
+            return cpy.convert_image(img, '', strength)
+        FLOYD_AVAILABLE = True
+    else:
+        FLOYD_AVAILABLE = False
+    
+    if hasattr(cpy, 'convert_image_atkinson'):
+        def convert_image_atkinson(img, strength):
+            return cpy.convert_image_atkinson(img, '', strength)
+        ATKINSON_AVAILABLE = True
+    else:
+        ATKINSON_AVAILABLE = False
+    
+    if hasattr(cpy, 'convert_image_linear'):
+        convert_image_linear = cpy.convert_image_linear
+        LINEAR_AVAILABLE = True
+    else:
+        LINEAR_AVAILABLE = False
+    
+    CYTHON_AVAILABLE = ATKINSON_AVAILABLE or FLOYD_AVAILABLE
+    
+    if CYTHON_AVAILABLE:
+        logger.info(f"Cython available: Floyd={FLOYD_AVAILABLE}, Atkinson={ATKINSON_AVAILABLE}, Linear={LINEAR_AVAILABLE}")
+    else:
+        logger.error("No dithering functions found in Cython module")
+
+except ImportError as e:
+    CYTHON_AVAILABLE = False
+    FLOYD_AVAILABLE = False
+    ATKINSON_AVAILABLE = False
+    LINEAR_AVAILABLE = False
+    logger.error(f"Cython not available: {e}")
+
+CYTHON_IMPORT_MS = round((time.perf_counter() - cython_import_started) * 1000, 1)
+
+# =============== STAGE TIMINGS & METRICS ===============
+# app.py sends stage timings to the Server-Timing header and metrics to
+# epf.db. A render pool worker collects its metrics and returns them with
+# the result, the parent process records them.
+stage_hook = None
+metric_hook = None
+worker_metrics = []
+LAZY_IMPORTS_MS = {}
+
+def set_hooks(stage=None, metric=None):
+    """Receive (name, duration_ms) of every timed stage and (name, value) of every metric"""
+    global stage_hook, metric_hook
+    stage_hook = stage
+    metric_hook = metric
+
+def init_worker(log_level):
+    """Render pool initializer: log like the server, collect metrics for the parent"""
+    logging.basicConfig(level=getattr(logging, log_level), format=LOG_FORMAT, stream=sys.stdout)
+    set_hooks(metric=lambda name, value: worker_metrics.append((name, value)))
+
+@contextmanager
+def timed_stage(name):
+    """Measure a pipeline stage and pass it to the stage hook (else it is only logged)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        if stage_hook is not None:
+            stage_hook(name, duration_ms)
+        logger.debug(f"Stage {name}: {duration_ms:.1f}ms")
+
+def emit_metric(name, value=1.0):
+    """Pass one metric observation to the metric hook"""
+    if metric_hook is not None:
+        metric_hook(name, value)
+
+# =============== LAZY CODEC LOADING ===============
+heif_lock = threading.Lock()
+heif_registered = False
+
+def record_lazy_import(name, started):
+    """Remember how long a lazy import took (shown in /debug/startup)"""
+    if name not in LAZY_IMPORTS_MS:
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        LAZY_IMPORTS_MS[name] = duration_ms
+        logger.info(f"Loaded {name} on first use in {duration_ms}ms")
+
+def load_rawpy():
+    """Import rawpy on first use (only needed for RAW/DNG assets)"""
+    started = time.perf_counter()
+    import rawpy
+    record_lazy_import('rawpy', started)
+    return rawpy
+
+def ensure_heif_opener():
+    """Import pillow_heif and register its PIL opener on first HEIC asset"""
+    global heif_registered
+    if heif_registered:
+        return
+    
+    with heif_lock:
+        if not heif_registered:
+            started = time.perf_counter()
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+            heif_registered = True
+            record_lazy_import('pillow_heif', started)
+
+# =============== IMAGE DECODING ===============
+RAW_EXTENSIONS = ('.raw', '.dng', '.arw', '.cr2', '.nef')
+RAW_STRATEGIES = ('auto', 'embedded', 'half', 'full')
+
+# LibRaw flip value -> transpose that brings the sensor image upright
+RAW_FLIP_TRANSPOSE = {
+    3: Image.Transpose.ROTATE_180,
+    5: Image.Transpose.ROTATE_90,
+    6: Image.Transpose.ROTATE_270,
+}
+
+def panel_scale_factor(width, height, settings):
+    """
+    Factor load_scaled will resize a width x height source by
+    (<= 1.0 means the source has enough pixels for the panel).
+    """
+    target_w, target_h = (480, 800) if settings['rotation'] in (90, 270) else (800, 480)
+    if settings['display_mode'] == 'fill':
+        return max(target_w / width, target_h / height)
+    return min(target_w / width, target_h / height)
+
+def extract_raw_preview(raw, rawpy):
+    """Embedded preview of a RAW file as upright PIL image, or None"""
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return None
+    
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        preview = Image.open(io.BytesIO(thumb.data))
+        preview.load()
+        if preview.getexif().get(0x0112, 1) != 1:
+            # The preview carries its own orientation tag
+            return ImageOps.exif_transpose(preview)
+    else:
+        preview = Image.fromarray(thumb.data)
+    
+    transpose = RAW_FLIP_TRANSPOSE.get(raw.sizes.flip)
+    return preview.transpose(transpose) if transpose else preview
+
+def decode_raw(image_data, settings):
+    """
+    Decode a RAW/DNG file according to the raw_strategy setting:
+    embedded preview if it has enough pixels for the panel, else a
+    half-size demosaic, else a full postprocess.
+    """
+    rawpy = load_rawpy()
+    strategy = settings['raw_strategy'] if settings['raw_strategy'] in RAW_STRATEGIES else 'auto'
+    start = time.perf_counter()
+    
+    with rawpy.imread(image_data) as raw:
+        image = None
+        used = None
+        
+        if strategy in ('auto', 'embedded'):
+            preview = extract_raw_preview(raw, rawpy)
+            if preview is not None and (strategy == 'embedded' or panel_scale_factor(*preview.size, settings) <= 1.0):
+                image, used = preview, 'embedded'
+        
+        if image is None and strategy in ('auto', 'embedded', 'half'):
+            half_w, half_h = raw.sizes.width // 2, raw.sizes.height // 2
+            if raw.sizes.flip in (5, 6):
+                half_w, half_h = half_h, half_w
+            if strategy != 'auto' or panel_scale_factor(half_w, half_h, settings) <= 1.0:
+                rgb = raw.postprocess(half_size=True, use_camera_wb=True, use_auto_wb=False)
+                image, used = Image.fromarray(rgb), 'half'
+        
+        if image is None:
+            rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
+            image, used = Image.fromarray(rgb), 'full'
+    
+    duration_ms = (time.perf_counter() - start) * 1000
+    emit_metric(f'raw_decode_{used}_ms', duration_ms)
+    logger.info(f"RAW decoded via {used} ({image.size[0]}x{image.size[1]}) in {duration_ms:.0f}ms")
+    return image
+
+def decode_image(image_data, original_path, settings):
+    """Open a downloaded asset as PIL image based on its file type"""
+    original_path = original_path.lower()
+    
+    if original_path.endswith(RAW_EXTENSIONS):
+        return decode_raw(image_data, settings)
+    
+    if original_path.endswith(('.heic', '.heif')):
+        ensure_heif_opener()
+        return Image.open(image_data).convert('RGB')
+    
+    image = Image.open(image_data)
+    image.load()
+    return image
+
+# =============== RAW/HEIC CONVERTERS ===============
+def convert_raw_or_dng_to_jpg(input_file_path, output_dir):
+    """Convert RAW/DNG to JPG"""
+    rawpy = load_rawpy()
+    with rawpy.imread(input_file_path) as raw:
+        rgb = raw.postprocess(use_camera_wb=True, use_auto_wb=False)
+    
+    basename = os.path.splitext(os.path.basename(input_file_path))[0]
+    jpg_path = os.path.join(output_dir, f'{basename}.jpg')
+    Image.fromarray(rgb).save(jpg_path, 'JPEG')
+    return jpg_path
+
+def convert_heic_to_jpg(input_file_path, output_dir):
+    """Convert HEIC to JPG"""
+    ensure_heif_opener()
+    img = Image.open(input_file_path).convert('RGB')
+    basename = os.path.splitext(os.path.basename(input_file_path))[0]
+    jpg_path = os.path.join(output_dir, f'{basename}.jpg')
+    img.save(jpg_path, 'JPEG', quality=95)
+    return jpg_path
+
+# =============== DATE OVERLAY ===============
+# The capture date is drawn into the dithered frame with palette colours only
+# (hard-edged glyphs, no anti-aliasing), so the frame stays palette-exact.
+# Fonts and rasterized glyphs are cached per size.
+DATE_FONT_PATH = '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf'
+DATE_POSITIONS = ('bottom-right', 'bottom-left', 'top-right', 'top-left', 'off')
+DATE_MARGIN = 40
+DATE_PADDING = 5
+DATE_TEXT_COLOUR = DITHER_COLOURS[1]  # White
+DATE_BOX_COLOUR = DITHER_COLOURS[0]  # Black
+
+@lru_cache(maxsize=8)
+def load_date_font(size):
+    try:
+        return ImageFont.truetype(DATE_FONT_PATH, size)
+    except OSError:
+        logger.warning(f"Font {DATE_FONT_PATH} not found, using default font")
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=512)
+def date_glyph(char, size):
+    """1-bit bitmap of one character (drawn at the origin) and its advance width"""
+    font = load_date_font(size)
+    left, top, right, bottom = font.getbbox(char)
+    glyph = Image.new('1', (max(right, 1), max(bottom, 1)))
+    draw = ImageDraw.Draw(glyph)
+    draw.fontmode = '1'
+    draw.text((0, 0), char, fill=1, font=font)
+    return np.array(glyph, dtype=bool), font.getlength(char)
+
+@lru_cache(maxsize=64)
+def date_text_mask(text, size):
+    """Boolean mask of the text, cropped to its ink, assembled from cached glyphs"""
+    glyphs = [date_glyph(char, size) for char in text]
+    if not glyphs:
+        return np.zeros((0, 0), dtype=bool)
+    advances = np.cumsum([0] + [advance for _, advance in glyphs])
+    width = max(int(round(x)) + bitmap.shape[1] for (bitmap, _), x in zip(glyphs, advances))
+    height = max(bitmap.shape[0] for bitmap, _ in glyphs)
+    
+    mask = np.zeros((height, width), dtype=bool)
+    for (bitmap, _), x in zip(glyphs, advances):
+        x = int(round(x))
+        mask[:bitmap.shape[0], x:x + bitmap.shape[1]] |= bitmap
+    
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return mask[:0, :0]
+    return mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+def format_exif_date(datetime_str, date_format):
+    """EXIF date in date_format, the raw value if unparseable"""
+    for pattern in ('%Y:%m:%d %H:%M:%S', '%Y.%m.%d'):
+        try:
+            return datetime.strptime(datetime_str, pattern).strftime(date_format)
+        except ValueError:
+            pass
+    return datetime_str
+
+def draw_date_overlay(frame, text, date_position, date_size):
+    """
+    Draw text on a black box into a dithered frame (H x W x 3 uint8 array,
+    modified in place) at date_position, using palette colours only.
+    """
+    mask = date_text_mask(text, date_size)
+    if not mask.size:
+        return
+    text_height, text_width = mask.shape
+    frame_height, frame_width = frame.shape[:2]
+    
+    x = DATE_MARGIN if date_position.endswith('left') else frame_width - DATE_MARGIN - text_width
+    y = DATE_MARGIN if date_position.startswith('top') else frame_height - DATE_MARGIN - text_height
+    box_left = min(max(x - DATE_PADDING, 0), max(frame_width - text_width - 2 * DATE_PADDING, 0))
+    box_top = min(max(y - DATE_PADDING, 0), max(frame_height - text_height - 2 * DATE_PADDING, 0))
+    
+    box = frame[box_top:box_top + text_height + 2 * DATE_PADDING, box_left:box_left + text_width + 2 * DATE_PADDING]
+    box[:] = DATE_BOX_COLOUR
+    text_area = box[DATE_PADDING:DATE_PADDING + text_height, DATE_PADDING:DATE_PADDING + text_width]
+    text_area[mask[:text_area.shape[0], :text_area.shape[1]]] = DATE_TEXT_COLOUR
+
+# =============== IMAGE PROCESSING ===============
+def scale_img_in_memory(image, settings, target_width=800, target_height=480, bg_color=(255, 255, 255)):
+    """
+    Process image in memory using Cython.
+    Supports both Atkinson and Floyd-Steinberg dithering.
+    """
+    rotation = settings['rotation']
+    display_mode = settings['display_mode']
+    dithering_method = settings['dithering_method']
+    strength = settings['strength']
+    date_position = settings['date_position']
+    
+    # Extract EXIF date
+    try:
+        exif = image.getexif()
+        datetime_str = exif.get(36867) if exif else None
+        if not datetime_str and exif:
+            datetime_str = exif.get(306)
+    except:
+        datetime_str = None
+    
+    # Check Cython availability
+    if not CYTHON_AVAILABLE:
+        logger.error("Cython not available - image processing will fail!")
+        raise RuntimeError("Cython module 'cpy' is required but not available")
+    
+    with timed_stage('scale'):
+        # EXIF orientation is applied by load_scaled after downscaling
+        try:
+            orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+        except Exception:
+            orientation = 1
+        
+        logger.info(f"Using Cython load_scaled(rotation={rotation}, mode={display_mode}, orientation={orientation})")
+        img = load_scaled(image, rotation, display_mode, orientation)
+        logger.info(f"Image after load_scaled: size={img.size}, mode={img.mode}")
+    
+    # Enhancement
+    with timed_stage('enhance'):
+        enhanced_img = ImageEnhance.Color(img).enhance(settings['enhanced'])
+        enhanced_img = ImageEnhance.Contrast(enhanced_img).enhance(settings['contrast'])
+        logger.info(f"Enhanced: color={settings['enhanced']}, contrast={settings['contrast']}")
+    
+    # Dithering
+    with timed_stage('dither'):
+        if settings['dithering_space'] == 'linear' and LINEAR_AVAILABLE:
+            logger.info(f"Using linear-light {dithering_method} dithering: strength={strength}")
+            frame = convert_image_linear(enhanced_img, dithering_method, strength)
+        elif dithering_method == 'floyd-steinberg' and FLOYD_AVAILABLE:
+            logger.info(f"Using Floyd-Steinberg dithering: strength={strength}")
+            frame = convert_image_floyd(enhanced_img, strength)
+        elif dithering_method == 'atkinson' and ATKINSON_AVAILABLE:
+            logger.info(f"Using Atkinson dithering: strength={strength}")
+            frame = convert_image_atkinson(enhanced_img, strength)
+        else:
+            # Fallback
+            if FLOYD_AVAILABLE:
+                logger.warning(f"{dithering_method} not available, using Floyd-Steinberg")
+                frame = convert_image_floyd(enhanced_img, strength)
+            else:
+                raise RuntimeError("No dithering method available")
+    
+    logger.info(f"Image after dithering: shape={frame.shape}")
+    
+    # Add date overlay (into the palette-exact frame, before it becomes an image)
+    if datetime_str and date_position != 'off':
+        with timed_stage('overlay'):
+            formatted_time = format_exif_date(datetime_str, settings['date_format'])
+            draw_date_overlay(frame, formatted_time, date_position, settings['date_size'])
+            logger.info(f"Date overlay: {formatted_time}")
+    
+    return Image.fromarray(frame, mode='RGB')
+
+def original_thumbnail(image_original):
+    """Unprocessed image, only resized to fit the display (for the web UI)"""
+    image_resized = image_original.copy()
+    image_resized.thumbnail((800, 480), Image.LANCZOS)
+    if image_resized.mode not in ('RGB', 'L'):
+        image_resized = image_resized.convert('RGB')
+    return image_resized
+
+# =============== SOURCE COPIES ===============
+SOURCE_CACHE_SIDE = 800
+
+def save_source_copy(image, path):
+    """
+    Save a panel-sized copy of a decoded photo (short side reduced to
+    SOURCE_CACHE_SIDE, EXIF kept) for the source cache. Returns its size in
+    bytes, None if it could not be written.
+    """
+    exif = image.info.get('exif')
+    try:
+        scale = SOURCE_CACHE_SIDE / min(image.size)
+        if scale < 1:
+            image = image.resize((round(image.width * scale), round(image.height * scale)),
+                                 Image.LANCZOS, reducing_gap=3.0)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, 'JPEG', quality=90, **({'exif': exif} if exif else {}))
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not save source copy {path}: {e}")
+        return None
+
+# =============== RENDER POOL ENTRY ===============
+def render_to_cache(image_data, original_path, frame_file, thumbnail_file, settings, source_file=None):
+    """
+    Decode one asset and write its dithered BMP and original thumbnail (and
+    its source copy if source_file is given). Runs in a render pool process;
+    the BMP is written last, so its presence marks a complete entry.
+    Returns (source copy size or None, [(metric, value)]) for the parent.
+    """
+    worker_metrics.clear()
+    image = decode_image(io.BytesIO(image_data), original_path, settings)
+    source_bytes = save_source_copy(image, source_file) if source_file else None
+    tmp_suffix = f".{os.getpid()}.tmp"
+    
+    original_thumbnail(image).save(thumbnail_file + tmp_suffix, 'JPEG', quality=85)
+    os.replace(thumbnail_file + tmp_suffix, thumbnail_file)
+    
+    scale_img_in_memory(image, settings).save(frame_file + tmp_suffix, 'BMP')
+    os.replace(frame_file + tmp_suffix, frame_file)
+    return source_bytes, list(worker_metrics)
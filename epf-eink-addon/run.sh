@@ -12,49 +12,62 @@ export DITHERING_STRENGTH=$(bashio::config 'dithering_strength' '1.0')
 export DISPLAY_MODE=$(bashio::config 'display_mode' 'fill')
 export IMAGE_ORDER=$(bashio::config 'image_order' 'random')
 export DITHERING_METHOD=$(bashio::config 'dithering_method' 'atkinson')
+export DITHERING_SPACE=$(bashio::config 'dithering_space' 'srgb')
 export WAKEUP_INTERVAL=$(bashio::config 'wakeup_interval' '1440')
+export WAKEUP_WINDOW=$(bashio::config 'wakeup_window' '10')
+export SOURCE_CACHE_SIZE=$(bashio::config 'source_cache_size' '500')
+export PHOTO_SOURCE=$(bashio::config 'photo_source' 'immich')
+export LOCAL_FOLDER=$(bashio::config 'local_folder' '/media/eink')
 export SLEEP_START_HOUR=$(bashio::config 'sleep_start_hour' '23')
 export SLEEP_START_MINUTE=$(bashio::config 'sleep_start_minute' '0')
 export SLEEP_END_HOUR=$(bashio::config 'sleep_end_hour' '6')
 export SLEEP_END_MINUTE=$(bashio::config 'sleep_end_minute' '0')
 export LOG_LEVEL=$(bashio::config 'log_level' 'info')
+export DEBUG_PROFILING=$(bashio::config 'debug_profiling' 'false')
+export RAW_STRATEGY=$(bashio::config 'raw_strategy' 'auto')
+export SHUFFLE_SEED=$(bashio::config 'shuffle_seed' '')
+export DATE_POSITION=$(bashio::config 'date_position' 'bottom-right')
+export DATE_SIZE=$(bashio::config 'date_size' '20')
+export DATE_FORMAT=$(bashio::config 'date_format' '%Y-%m-%d')
 
 # Set INGRESS_PATH directly (Home Assistant provides this automatically)
 # If running in Ingress mode, HA handles the routing without needing the token
 export INGRESS_PATH="/api/hassio_ingress"
 
-if [ -z "${IMMICH_API_KEY}" ]; then
+if [ "${PHOTO_SOURCE}" != "folder" ] && [ -z "${IMMICH_API_KEY}" ]; then
     bashio::log.fatal "IMMICH_API_KEY is required!"
     exit 1
 fi
 
-if [ -z "${IMMICH_URL}" ]; then
+if [ "${PHOTO_SOURCE}" != "folder" ] && [ -z "${IMMICH_URL}" ]; then
     bashio::log.fatal "IMMICH_URL is required!"
     exit 1
 fi
 
 bashio::log.info "Configuration loaded:"
+bashio::log.info "  Photo Source: ${PHOTO_SOURCE}"
+bashio::log.info "  Local Folder: ${LOCAL_FOLDER}"
 bashio::log.info "  Immich URL: ${IMMICH_URL}"
 bashio::log.info "  Album: ${ALBUM_NAME}"
+bashio::log.info "  Source Cache: ${SOURCE_CACHE_SIZE} MB"
 bashio::log.info "  Rotation: ${ROTATION_ANGLE}°"
 bashio::log.info "  Color Enhance: ${COLOR_ENHANCE}"
 bashio::log.info "  Contrast: ${CONTRAST}"
 bashio::log.info "  Dithering Strength: ${DITHERING_STRENGTH}"
 bashio::log.info "  Display Mode: ${DISPLAY_MODE}"
 bashio::log.info "  Image Order: ${IMAGE_ORDER}"
-bashio::log.info "  Dithering Method: ${DITHERING_METHOD}"
-bashio::log.info "  Wake Up Interval: ${WAKEUP_INTERVAL} minutes"
+bashio::log.info "  Shuffle Seed: ${SHUFFLE_SEED:-random}"
+bashio::log.info "  Dithering Method: ${DITHERING_METHOD} (${DITHERING_SPACE})"
+bashio::log.info "  RAW Strategy: ${RAW_STRATEGY}"
+bashio::log.info "  Date Overlay: ${DATE_POSITION}, ${DATE_SIZE}px, ${DATE_FORMAT}"
+bashio::log.info "  Wake Up Interval: ${WAKEUP_INTERVAL} minutes (spread over ${WAKEUP_WINDOW} minutes)"
 bashio::log.info "  Sleep Time: ${SLEEP_START_HOUR}:${SLEEP_START_MINUTE} - ${SLEEP_END_HOUR}:${SLEEP_END_MINUTE}"
 bashio::log.info "  Log Level: ${LOG_LEVEL}"
+bashio::log.info "  Debug Profiling: ${DEBUG_PROFILING}"
 
 cd /app || exit 1
 
 exec gunicorn \
-    --bind 0.0.0.0:5000 \
-    --workers 2 \
-    --threads 2 \
-    --timeout 120 \
-    --access-logfile - \
-    --error-logfile - \
+    --config gunicorn.conf.py \
     --log-level ${LOG_LEVEL} \
     app:app
\ No newline at end of file
@@ -0,0 +1,34 @@
+"""
+Tone accuracy of the linear-light dithering kernel: a flat patch has to keep
+its mean colour (in linear light) for both methods. Needs the built cpy
+module (python setup.py build_ext --inplace); run with pytest from the add-on
+directory.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+cpy = pytest.importorskip('cpy')
+
+
+@pytest.mark.parametrize('method', ['atkinson', 'floyd-steinberg'])
+@pytest.mark.parametrize('colour', [
+    (128, 128, 128),
+    (200, 150, 120),
+    (230, 230, 230),
+    (40, 40, 40),
+], ids=['gray128', 'skin', 'light-gray', 'dark-gray'])
+def test_flat_patch_mean_colour(method, colour):
+    patch = np.full((120, 160, 3), colour, dtype=np.uint8)
+    frame = cpy.convert_image_linear(patch, method, 1.0)
+
+    # Every pixel is a panel colour; the margin skips the edges, where part
+    # of the error leaves the frame
+    panel = {tuple(c) for c in cpy.PANEL_COLORS}
+    assert {tuple(c) for c in frame.reshape(-1, 3)} <= panel
+    mean = cpy.SRGB_TO_LINEAR[frame[10:-10, 10:-10]].reshape(-1, 3).mean(axis=0)
+    assert mean == pytest.approx(cpy.SRGB_TO_LINEAR[list(colour)], abs=0.01)
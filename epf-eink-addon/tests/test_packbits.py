@@ -0,0 +1,69 @@
+"""
+Round trip of the PackBits frame encoding against the reference decoder,
+which mirrors the ESP32's streaming decoder. Run with pytest from the add-on
+directory.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from framecodec import packbits_encode, packbits_decode
+
+
+def packets(encoded):
+    """Split an encoded stream into (control, data) packets"""
+    result = []
+    i = 0
+    while i < len(encoded):
+        control = encoded[i]
+        size = control + 1 if control < 128 else (1 if control > 128 else 0)
+        result.append((control, encoded[i + 1:i + 1 + size]))
+        i += 1 + size
+    return result
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x11',
+    b'\x11\x11',
+    b'\x11' * 128,
+    b'\x11' * 129,
+    b'\x11' * 130,
+    b'\x01\x11' + b'\x22' * 129 + b'\x33',
+    b'\x10\x20' * 64,
+    bytes(range(256)) * 2,
+    bytes(range(200)) + b'\x00' * 3 + bytes(range(200)),
+], ids=['empty', 'run-1', 'run-2', 'run-128', 'run-129', 'run-130', 'runs-in-literals',
+        'literals-128', 'literals-512', 'literals-around-run'])
+def test_round_trip(data):
+    encoded = packbits_encode(data)
+    assert packbits_decode(encoded) == data
+    for control, payload in packets(encoded):
+        # The firmware never sees the no-op byte or an overlong packet
+        assert control != 128
+        assert len(payload) == (control + 1 if control < 128 else 1)
+
+
+def test_repeat_packets():
+    assert packbits_encode(b'\x11' * 128) == bytes([129, 0x11])
+    assert packbits_encode(b'\x11' * 129) == bytes([129, 0x11, 0, 0x11])
+    assert packbits_encode(b'\x11' * 130) == bytes([129, 0x11, 255, 0x11])
+    assert packbits_encode(b'\x11\x11') == bytes([1, 0x11, 0x11])
+
+
+def test_literal_only_worst_case():
+    data = bytes(range(256)) * 4
+    encoded = packbits_encode(data)
+    assert packbits_decode(encoded) == data
+    assert len(encoded) == len(data) + len(data) // 128
+
+
+def test_random_frames():
+    rng = np.random.default_rng(0)
+    for runs in (1, 4, 64):
+        data = np.repeat(rng.integers(0, 256, 4096 // runs, dtype=np.uint8), runs).tobytes()
+        assert packbits_decode(packbits_encode(data)) == data